@@ -0,0 +1,101 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+from benchmarks import latency, resources, ringbuffer, throughput
+
+
+SUITES = ('bulk', 'latency', 'scaling', 'resources', 'ringbuffer')
+
+
+def run(suite, transports, quick):
+    scale = 16 if quick else 1
+
+    if suite == 'ringbuffer':
+        return ringbuffer.run_all(scale)
+
+    results = []
+    for i in transports:
+        if suite == 'bulk':
+            results.append(throughput.bulk(i, total=256 * 1024 * 1024 // scale))
+        elif suite == 'latency':
+            results.append(latency.round_trip(i, count=20000 // scale))
+        elif suite == 'scaling':
+            for count in (1, 10, 100, 1000, 10000):
+                if quick and count > 1000:
+                    break
+
+                results.append(throughput.scaling(i, count))
+        elif suite == 'resources':
+            results.append(resources.per_channel(i, channels=10000 // scale))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='msock benchmark suite')
+    parser.add_argument('suites', nargs='*', help='suites to run: {0} (default: all)'.format(', '.join(SUITES)))
+    parser.add_argument('-t', '--transport', action='append', choices=('unix', 'shm', 'tcp'), help='transports to use')
+    parser.add_argument('-o', '--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('-q', '--quick', action='store_true', help='run a reduced version of every suite')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    for i in args.suites:
+        if i not in SUITES:
+            parser.error('unknown suite {0}'.format(i))
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    transports = args.transport or ['unix', 'tcp']
+    report = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'quick': args.quick,
+        'results': []
+    }
+
+    for i in args.suites or SUITES:
+        print('running {0}'.format(i), file=sys.stderr)
+        report['results'].extend(run(i, transports, args.quick))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        return
+
+    json.dump(report, sys.stdout, indent=4)
+    print()
+
+
+if __name__ == '__main__':
+    main()
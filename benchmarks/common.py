@@ -0,0 +1,102 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import os
+import socket
+import tempfile
+import threading
+import time
+from msock.client import Client
+from msock.server import Server
+
+
+def make_uri(scheme):
+    if scheme in ('unix', 'shm'):
+        return '{0}://{1}'.format(scheme, os.path.join(tempfile.mkdtemp(prefix='msock-bench-'), 'sock'))
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return 'tcp://127.0.0.1:{0}'.format(port)
+
+
+def connect(scheme, configure=None):
+    uri = make_uri(scheme)
+    server = Server()
+    if configure:
+        configure(server)
+
+    accepted = []
+    ready = threading.Event()
+
+    def on_connection(conn):
+        accepted.append(conn)
+        ready.set()
+
+    server.on_connection = on_connection
+    server.open(uri)
+    threading.Thread(target=server.run, daemon=True, name='bench server').start()
+
+    client = Client()
+    for _ in range(100):
+        try:
+            client.connect(uri)
+            break
+        except OSError:
+            time.sleep(0.01)
+
+    ready.wait()
+    return client, accepted[0]
+
+
+def channel_pair(client, server, id, policy=None):
+    return client.create_channel(id, policy=policy), server.create_channel(id, policy=policy)
+
+
+def read_exactly(chan, buffer):
+    view = memoryview(buffer)
+    done = 0
+    while done < len(view):
+        ret = chan.readinto(view[done:])
+        if ret == 0:
+            break
+
+        done += ret
+
+    return done
+
+
+def percentiles(samples, points=(50, 90, 99, 99.9)):
+    samples = sorted(samples)
+    result = {}
+    for i in points:
+        index = min(len(samples) - 1, int(round(i / 100.0 * (len(samples) - 1))))
+        result['p{0}'.format(i)] = samples[index]
+
+    return result
+
@@ -0,0 +1,62 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import threading
+import time
+from benchmarks.common import connect, channel_pair, read_exactly, percentiles
+
+
+def round_trip(scheme, count=20000, size=64):
+    client, server = connect(scheme)
+    tx, rx = channel_pair(client, server, 1)
+
+    def echo():
+        buffer = bytearray(size)
+        while read_exactly(rx, buffer) == size:
+            rx.write(buffer)
+
+    threading.Thread(target=echo, daemon=True).start()
+    payload = bytes(size)
+    buffer = bytearray(size)
+    samples = []
+
+    for _ in range(count):
+        start = time.perf_counter()
+        tx.write(payload)
+        read_exactly(tx, buffer)
+        samples.append((time.perf_counter() - start) * 1e6)
+
+    client.close()
+    metrics = percentiles(samples)
+    metrics['mean'] = sum(samples) / len(samples)
+    return {
+        'name': 'round_trip',
+        'transport': scheme,
+        'params': {'count': count, 'size': size},
+        'metrics': metrics,
+        'unit': 'us'
+    }
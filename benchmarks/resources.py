@@ -0,0 +1,58 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import gc
+import threading
+import tracemalloc
+from benchmarks.common import connect, channel_pair
+
+
+def per_channel(scheme, channels=10000):
+    client, server = connect(scheme)
+    gc.collect()
+    threads = threading.active_count()
+    # RSS moves in pages and arenas and buffers don't show up until touched, count what
+    # actually gets allocated while the channels are created instead
+    tracemalloc.start()
+    pairs = [channel_pair(client, server, i + 1) for i in range(channels)]
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    threads = threading.active_count() - threads
+    buffers = sum(a.memory_usage + b.memory_usage for a, b in pairs)
+    client.close()
+    del pairs
+    return {
+        'name': 'per_channel',
+        'transport': scheme,
+        'params': {'channels': channels},
+        'metrics': {
+            'allocated_bytes_per_channel': memory / (2 * channels),
+            'buffer_bytes_per_channel': buffers / (2 * channels),
+            'threads_per_channel': threads / (2 * channels),
+        }
+    }
@@ -0,0 +1,86 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import threading
+import time
+from msock.ringbuffer import RingBuffer, SPSCRingBuffer
+
+
+def uncontended(cls, size=64, count=200000):
+    ring = cls(65536)
+    payload = bytes(size)
+    buffer = bytearray(size)
+    start = time.perf_counter()
+    for _ in range(count):
+        ring.write(payload)
+        ring.read_into(buffer)
+
+    elapsed = time.perf_counter() - start
+    return {
+        'name': 'ringbuffer_uncontended',
+        'params': {'class': cls.__name__, 'size': size, 'count': count},
+        'metrics': {'ns_per_op': elapsed / count * 1e9}
+    }
+
+
+def contended(cls, size=1024, total=32 * 1024 * 1024):
+    ring = cls(65536)
+    payload = memoryview(bytes(size))
+
+    def producer():
+        for _ in range(total // size):
+            ring.writeall(payload)
+
+        ring.close()
+
+    buffer = bytearray(size)
+    received = 0
+    start = time.perf_counter()
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        ret = ring.read_into(buffer)
+        if ret == 0:
+            break
+
+        received += ret
+
+    elapsed = time.perf_counter() - start
+    return {
+        'name': 'ringbuffer_contended',
+        'params': {'class': cls.__name__, 'size': size, 'total': total},
+        'metrics': {'bytes_per_second': received / elapsed}
+    }
+
+
+def run_all(scale=1):
+    results = []
+    for cls in (RingBuffer, SPSCRingBuffer):
+        for size in (64, 1024):
+            results.append(uncontended(cls, size, count=200000 // scale))
+            results.append(contended(cls, size, total=size * 32 * 1024 // scale))
+
+    return results
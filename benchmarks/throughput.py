@@ -0,0 +1,102 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import os
+import threading
+import time
+from msock.buffers import BufferPolicy
+from benchmarks.common import connect, channel_pair, read_exactly
+
+
+def bulk(scheme, total=256 * 1024 * 1024, chunk=64 * 1024, policy=None):
+    policy = policy or BufferPolicy(64 * 1024, maximum=4 * 1024 * 1024)
+    client, server = connect(scheme)
+    tx, rx = channel_pair(client, server, 1, policy)
+    payload = os.urandom(chunk)
+
+    def writer():
+        for _ in range(total // chunk):
+            tx.write(payload)
+
+    buffer = bytearray(1024 * 1024)
+    received = 0
+    start = time.perf_counter()
+    threading.Thread(target=writer, daemon=True).start()
+    while received < total:
+        ret = rx.readinto(buffer)
+        if ret == 0:
+            break
+
+        received += ret
+
+    elapsed = time.perf_counter() - start
+    client.close()
+    return {
+        'name': 'bulk',
+        'transport': scheme,
+        'params': {'total': total, 'chunk': chunk},
+        'metrics': {
+            'seconds': elapsed,
+            'bytes_per_second': received / elapsed,
+        }
+    }
+
+
+def scaling(scheme, channels, rounds=16, chunk=1024, workers=16):
+    client, server = connect(scheme)
+    pairs = [channel_pair(client, server, i + 1) for i in range(channels)]
+    payload = os.urandom(chunk)
+    workers = min(workers, channels)
+
+    def worker(mine):
+        buffer = bytearray(chunk)
+        for _ in range(rounds):
+            for tx, rx in mine:
+                tx.write(payload)
+
+            for tx, rx in mine:
+                read_exactly(rx, buffer)
+
+    threads = [threading.Thread(target=worker, args=(pairs[i::workers],)) for i in range(workers)]
+    start = time.perf_counter()
+    for i in threads:
+        i.start()
+
+    for i in threads:
+        i.join()
+
+    elapsed = time.perf_counter() - start
+    client.close()
+    return {
+        'name': 'scaling',
+        'transport': scheme,
+        'params': {'channels': channels, 'rounds': rounds, 'chunk': chunk, 'workers': workers},
+        'metrics': {
+            'seconds': elapsed,
+            'bytes_per_second': channels * rounds * chunk / elapsed,
+        }
+    }
@@ -0,0 +1,561 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import asyncio
+import logging
+import socket
+import struct
+from msock.channel import ChannelType
+from msock.client import (
+    HEADER_MAGIC, HEADER_FORMAT, HEADER_SIZE, CONTROL_CHANNEL, CONTROL_FORMAT, CONTROL_SIZE, CHANNEL_TYPES,
+    FRAME_LENGTH_MASK, ControlCommand
+)
+from msock.ids import ChannelIdAllocator
+from msock.utils import parse_uri
+
+
+# shm:// needs descriptor passing, which the asyncio transports don't do
+ASYNC_SCHEMES = ('tcp', 'unix')
+
+
+class AsyncChannel(object):
+    def __init__(self, connection, id, type=ChannelType.DATA, bufsize=4096):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._id = id
+        self._type = type
+        self._connection = connection
+        self._closed = False
+        self._eof = False
+        self._eof_sent = False
+        self._window = bufsize - 1
+        self._recvbuf = bytearray()
+        self._sendbuf = bytearray()
+        self._credit = 0
+        self._unacked = 0
+        self._readable = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+
+    @property
+    def connection(self):
+        return self._connection
+
+    @property
+    def type(self):
+        return self._type
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def window(self):
+        return self._window
+
+    def on_data(self, data):
+        if data == b'':
+            self._logger.debug('Channel {0} closed'.format(self._id))
+            self._set_eof()
+            return
+
+        if len(data) > self._window - len(self._recvbuf):
+            self._logger.warning('Channel {0} receive window exceeded, discarding'.format(self._id))
+            return
+
+        self._recvbuf += data
+        self._readable.set()
+
+    def on_window_update(self, credit):
+        self._credit += credit
+        self._flush()
+
+    def on_window_shrink(self, credit):
+        # the peer's window went idle, give back what we haven't used of it
+        credit = min(credit, max(self._credit, 0))
+        self._credit -= credit
+        self._connection.send_control(ControlCommand.WINDOW_RETURN, self._id, credit)
+
+    def at_eof(self):
+        return self._eof and not self._recvbuf
+
+    async def read(self, n=-1):
+        if n < 0:
+            chunks = []
+            while True:
+                chunk = await self.read(self._window)
+                if not chunk:
+                    return b''.join(chunks)
+
+                chunks.append(chunk)
+
+        while not self._recvbuf and not self._eof:
+            self._readable.clear()
+            await self._readable.wait()
+
+        data = bytes(self._recvbuf[:n])
+        del self._recvbuf[:n]
+        self._consumed(len(data))
+        return data
+
+    async def readexactly(self, n):
+        result = bytearray()
+        while len(result) < n:
+            chunk = await self.read(n - len(result))
+            if not chunk:
+                raise asyncio.IncompleteReadError(bytes(result), n)
+
+            result += chunk
+
+        return bytes(result)
+
+    def write(self, data):
+        if self._closed:
+            raise RuntimeError('Channel {0} is closed'.format(self._id))
+
+        self._sendbuf += data
+        self._flush()
+
+    async def drain(self):
+        await self._drained.wait()
+        await self._connection.drain()
+
+    def close(self):
+        if self._closed:
+            return
+
+        self._closed = True
+        self._logger.debug('Cleaning up resources associated with channel {0}'.format(self._id))
+        self._flush()
+
+    async def wait_closed(self):
+        await self._drained.wait()
+
+    def _consumed(self, nbytes):
+        self._unacked += nbytes
+        if self._unacked < self._window // 4:
+            return
+
+        self._connection.send_window_update(self._id, self._unacked)
+        self._unacked = 0
+
+    def _flush(self):
+        while self._sendbuf and self._credit > 0:
+            data = bytes(self._sendbuf[:self._credit])
+            del self._sendbuf[:len(data)]
+            self._credit -= len(data)
+            self._connection.send(self._id, data)
+
+        if self._sendbuf and not self._connection.closed:
+            self._drained.clear()
+            return
+
+        if self._closed and not self._eof_sent:
+            self._eof_sent = True
+            self._logger.debug('EOF received on channel {0}, closing'.format(self._id))
+            self._connection.send(self._id, b'')
+            self._set_eof()
+
+        self._drained.set()
+
+    def _set_eof(self):
+        self._eof = True
+        self._readable.set()
+
+    def _connection_lost(self):
+        self._closed = True
+        self._set_eof()
+        self._drained.set()
+
+
+class AsyncConnection(asyncio.Protocol):
+    def __init__(self):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.on_opened = lambda: None
+        self.on_channel_created = lambda chan: None
+        self.on_channel_destroyed = lambda chan: None
+        self.on_closed = lambda: None
+        self.channel_factory = lambda id: AsyncChannel(self, id)
+        self.channel_ids = ChannelIdAllocator()
+        self.accept_channels = False
+        self._channels = {}
+        self._closing = set()
+        self._pending_credit = {}
+        self._address = None
+        self._transport = None
+        self._buffer = bytearray()
+        self._closed = True
+        self._paused = False
+        self._drain_waiters = []
+        self._on_lost = lambda: None
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def remote_address(self):
+        return self._address
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def create_channel(self, id=None):
+        if id is None:
+            id = self.channel_ids.allocate(lambda i: i in self._channels or i in self._closing)
+
+        if id == CONTROL_CHANNEL:
+            raise RuntimeError('Channel {0} is reserved for control frames'.format(id))
+
+        if id in self._channels:
+            raise RuntimeError('Channel {0} already exists'.format(id))
+
+        chan = self._create_channel(id)
+        self.on_channel_created(chan)
+        return chan
+
+    def destroy_channel(self, id):
+        self.destroy_channels((id,))
+
+    def destroy_channels(self, ids=None):
+        if ids is None:
+            ids = list(self._channels)
+
+        for id in ids:
+            chan = self._channels.pop(id, None)
+            if chan is None:
+                continue
+
+            self._logger.debug('Destroying channel {0}'.format(id))
+            self._closing.add(id)
+            self.send_control(ControlCommand.CLOSE, id)
+            chan._connection_lost()
+            self.on_channel_destroyed(chan)
+
+    def _create_channel(self, id):
+        chan = self.channel_factory(id)
+        self._channels[id] = chan
+        credit = self._pending_credit.pop(id, 0)
+        if credit:
+            chan.on_window_update(credit)
+
+        self.send_control(ControlCommand.OPEN, id, CHANNEL_TYPES.index(chan.type))
+        self.send_window_update(id, chan.window)
+        self._logger.debug('Created channel {0}'.format(id))
+        return chan
+
+    def send(self, channel_id, data):
+        if self._closed:
+            return
+
+        header = struct.pack(
+            HEADER_FORMAT,
+            HEADER_MAGIC,
+            channel_id,
+            len(data)
+        )
+
+        self._transport.writelines((header, data))
+
+    def send_control(self, command, channel_id, argument=0):
+        self.send(CONTROL_CHANNEL, struct.pack(CONTROL_FORMAT, command, channel_id, argument))
+
+    def send_window_update(self, channel_id, credit):
+        self.send_control(ControlCommand.WINDOW_UPDATE, channel_id, credit)
+
+    async def drain(self):
+        if not self._paused or self._closed:
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+    def close(self):
+        if self._closed:
+            return
+
+        self._transport.close()
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._address = transport.get_extra_info('peername')
+        self._closed = False
+        self.on_opened()
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            self._logger.info('Read failed: {0}'.format(exc))
+
+        self._closed = True
+        self._logger.debug('Connection closed')
+        for i in list(self._channels.values()):
+            i._connection_lost()
+
+        self._channels.clear()
+        self._closing.clear()
+        self._pending_credit.clear()
+        self._wake_drain_waiters()
+        self._on_lost()
+        self.on_closed()
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake_drain_waiters()
+
+    def data_received(self, data):
+        self._buffer += data
+        offset = 0
+
+        while len(self._buffer) - offset >= HEADER_SIZE:
+            magic, channel_id, length = struct.unpack_from(HEADER_FORMAT, self._buffer, offset)
+            if magic != HEADER_MAGIC:
+                self._logger.debug('Wrong magic received ({0:04x})'.format(magic))
+                self._transport.close()
+                return
+
+            end = offset + HEADER_SIZE + (length & FRAME_LENGTH_MASK)
+            if len(self._buffer) < end:
+                break
+
+            payload = bytes(self._buffer[offset + HEADER_SIZE:end])
+            offset = end
+
+            if length & ~FRAME_LENGTH_MASK:
+                # compression, message boundaries and descriptors are not implemented here
+                self._logger.warning('Unsupported frame flags {0:08x} on channel {1}, closing it'.format(
+                    length & ~FRAME_LENGTH_MASK,
+                    channel_id
+                ))
+                if channel_id != CONTROL_CHANNEL:
+                    self.destroy_channel(channel_id)
+
+                continue
+
+            if channel_id == CONTROL_CHANNEL:
+                self._on_control(payload)
+                continue
+
+            if channel_id in self._closing:
+                # still in flight for a destroyed channel, a new one may already be using the ID
+                continue
+
+            chan = self._channels.get(channel_id)
+            if chan is None:
+                self._logger.warning('Data from unknown channel {0} received, discarding'.format(channel_id))
+                continue
+
+            chan.on_data(payload)
+
+        del self._buffer[:offset]
+
+    def _on_control(self, data):
+        if len(data) < CONTROL_SIZE:
+            self._logger.warning('Truncated control frame received, discarding')
+            return
+
+        command, channel_id, argument = struct.unpack_from(CONTROL_FORMAT, data)
+        if command == ControlCommand.WINDOW_UPDATE:
+            if channel_id in self._closing:
+                # meant for the instance we destroyed, the peer's CLOSE is the last of those
+                return
+
+            chan = self._channels.get(channel_id)
+            if chan is None:
+                self._pending_credit[channel_id] = self._pending_credit.get(channel_id, 0) + argument
+                return
+
+            chan.on_window_update(argument)
+            return
+
+        if command == ControlCommand.WINDOW_SHRINK:
+            chan = None if channel_id in self._closing else self._channels.get(channel_id)
+            if chan is not None:
+                chan.on_window_shrink(argument)
+
+            return
+
+        if command == ControlCommand.OPEN:
+            if argument >= len(CHANNEL_TYPES) or CHANNEL_TYPES[argument] != ChannelType.DATA:
+                self._logger.warning('Refusing channel {0} of unsupported type opened by peer'.format(channel_id))
+                if channel_id in self._channels:
+                    self.destroy_channel(channel_id)
+                elif channel_id not in self._closing:
+                    self._closing.add(channel_id)
+                    self.send_control(ControlCommand.CLOSE, channel_id)
+
+                return
+
+            if self.accept_channels and channel_id not in self._channels and channel_id not in self._closing:
+                self.on_channel_created(self._create_channel(channel_id))
+
+            return
+
+        if command == ControlCommand.CLOSE:
+            self._on_close(channel_id)
+            return
+
+        if command == ControlCommand.PING:
+            self.send_control(ControlCommand.PONG, CONTROL_CHANNEL, argument)
+            return
+
+        if command == ControlCommand.PONG:
+            return
+
+        self._logger.warning('Unknown control command {0} received, discarding'.format(command))
+
+    def _on_close(self, channel_id):
+        self._pending_credit.pop(channel_id, None)
+        if channel_id in self._closing:
+            self._closing.discard(channel_id)
+            self.channel_ids.release(channel_id)
+            return
+
+        chan = self._channels.pop(channel_id, None)
+        if chan is not None:
+            self._logger.debug('Channel {0} closed by peer'.format(channel_id))
+            chan._connection_lost()
+            self.on_channel_destroyed(chan)
+
+        self.send_control(ControlCommand.CLOSE, channel_id)
+        self.channel_ids.release(channel_id)
+
+    def _wake_drain_waiters(self):
+        for i in self._drain_waiters:
+            if not i.done():
+                i.set_result(None)
+
+        self._drain_waiters.clear()
+
+
+class AsyncClient(AsyncConnection):
+    def __init__(self):
+        super(AsyncClient, self).__init__()
+        self._uri = None
+
+    async def connect(self, uri):
+        af, address = parse_uri(uri, ASYNC_SCHEMES)
+        loop = asyncio.get_running_loop()
+        self._uri = uri
+        if af == socket.AF_UNIX:
+            await loop.create_unix_connection(lambda: self, address)
+            return
+
+        await loop.create_connection(lambda: self, *address)
+
+    def disconnect(self):
+        self.close()
+
+
+class AsyncServer(object):
+    def __init__(self):
+        self.on_connection = lambda conn: None
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._uri = None
+        self._server = None
+        self._connections = []
+        self._idle = asyncio.Event()
+
+    @property
+    def connections(self):
+        return self._connections
+
+    async def open(self, uri):
+        af, address = parse_uri(uri, ASYNC_SCHEMES)
+        loop = asyncio.get_running_loop()
+        self._uri = uri
+        if af == socket.AF_UNIX:
+            self._server = await loop.create_unix_server(self._create_connection, address, start_serving=False)
+            return
+
+        self._server = await loop.create_server(
+            self._create_connection,
+            *address,
+            reuse_address=True,
+            start_serving=False
+        )
+
+    async def listen(self, sock):
+        loop = asyncio.get_running_loop()
+        self._uri = sock.getsockname()
+        if sock.family == socket.AF_UNIX:
+            self._server = await loop.create_unix_server(self._create_connection, sock=sock, start_serving=False)
+            return
+
+        self._server = await loop.create_server(self._create_connection, sock=sock, start_serving=False)
+
+    async def start(self):
+        self._logger.debug('Listening for client connections on {0}'.format(self._uri))
+        await self._server.start_serving()
+
+    async def run(self):
+        self._logger.debug('Listening for client connections on {0}'.format(self._uri))
+        await self._server.serve_forever()
+
+    async def drain(self, timeout=None):
+        # stop accepting and give the connections we have a chance to finish on their own
+        self._server.close()
+        if self._connections:
+            self._idle.clear()
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                self._logger.info('{0} connections still open after drain, closing'.format(len(self._connections)))
+
+        self.close()
+
+    def close(self):
+        self._server.close()
+        for i in list(self._connections):
+            i.close()
+
+    def _create_connection(self):
+        conn = AsyncConnection()
+        conn.channel_ids = ChannelIdAllocator(ChannelIdAllocator.SERVER)
+        conn.on_opened = lambda: self._on_opened(conn)
+        conn._on_lost = lambda: self._on_lost(conn)
+        return conn
+
+    def _on_lost(self, conn):
+        self._connections.remove(conn)
+        if not self._connections:
+            self._idle.set()
+
+    def _on_opened(self, conn):
+        self._logger.debug('Accepted client from {0}'.format(conn.remote_address))
+        self._connections.append(conn)
+        result = self.on_connection(conn)
+        if asyncio.iscoroutine(result):
+            asyncio.get_running_loop().create_task(result)
@@ -0,0 +1,71 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import threading
+
+
+class BufferPolicy(object):
+    def __init__(self, initial=4096, maximum=None, minimum=None, idle_timeout=5.0):
+        self.initial = initial
+        self.maximum = max(maximum or initial, initial)
+        self.minimum = min(minimum or initial, initial)
+        self.idle_timeout = idle_timeout
+
+    @property
+    def growable(self):
+        return self.maximum > self.minimum
+
+
+class MemoryBudget(object):
+    def __init__(self, limit):
+        self._limit = limit
+        self._used = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @property
+    def used(self):
+        return self._used
+
+    @property
+    def available(self):
+        return self._limit - self._used
+
+    def reserve(self, nbytes):
+        with self._lock:
+            if self._used + nbytes > self._limit:
+                return False
+
+            self._used += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self._lock:
+            self._used -= nbytes
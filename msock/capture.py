@@ -0,0 +1,188 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import collections
+import enum
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+CAPTURE_MAGIC = b'MSCP'
+CAPTURE_VERSION = 1
+CAPTURE_SIZE = 64 * 1024 * 1024
+# magic, version, capacity, head, tail, used, records, dropped, wall clock time at start
+CAPTURE_HEADER_FORMAT = '<4sI6Qd'
+CAPTURE_HEADER_SIZE = 64
+# nanoseconds since start, channel, length field as on the wire, captured bytes, direction
+RECORD_FORMAT = '<QIIIB3x'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+
+class Direction(enum.IntEnum):
+    PAD = 0
+    IN = 1
+    OUT = 2
+
+
+Record = collections.namedtuple('Record', ['timestamp', 'direction', 'channel_id', 'length', 'payload'])
+
+
+class Capture(object):
+    """
+    Records frames into a memory-mapped file used as a ring: once it is full the oldest
+    records make room for new ones. Only the first snaplen bytes of each payload are kept,
+    none by default, so the cost of a record is a lock and a few stores into the mapping.
+    """
+    def __init__(self, path, size=CAPTURE_SIZE, snaplen=0):
+        if size < CAPTURE_HEADER_SIZE + RECORD_SIZE:
+            raise ValueError('Capture size must be at least {0} bytes'.format(CAPTURE_HEADER_SIZE + RECORD_SIZE))
+
+        self.snaplen = snaplen
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._view = memoryview(self._map)
+        self._capacity = size - CAPTURE_HEADER_SIZE
+        self._head = 0
+        self._tail = 0
+        self._used = 0
+        self._records = 0
+        self._dropped = 0
+        self._start = time.monotonic_ns()
+        self._started = time.time()
+        self._lock = threading.Lock()
+        self._sync()
+
+    @property
+    def records(self):
+        return self._records
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    def record(self, direction, channel_id, length, data=b'', snaplen=None):
+        data = data[:self.snaplen if snaplen is None else snaplen]
+        size = RECORD_SIZE + len(data)
+        timestamp = time.monotonic_ns() - self._start
+        with self._lock:
+            if self._view is None or size > self._capacity:
+                self._dropped += 1
+                return
+
+            if self._head + size > self._capacity:
+                # no room before the end: the rest becomes padding and we start over in front
+                self._reclaim(self._capacity - self._head)
+                if self._capacity - self._head >= RECORD_SIZE:
+                    self._pack(self._head, 0, 0, 0, self._capacity - self._head - RECORD_SIZE, Direction.PAD)
+
+                self._used += self._capacity - self._head
+                self._head = 0
+
+            self._reclaim(size)
+            self._pack(self._head, timestamp, channel_id, length, len(data), direction)
+            offset = CAPTURE_HEADER_SIZE + self._head + RECORD_SIZE
+            self._view[offset:offset + len(data)] = data
+            self._head += size
+            self._used += size
+            self._records += 1
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._view is None:
+                return
+
+            self._sync()
+            self._view.release()
+            self._view = None
+            self._map.close()
+            os.close(self._fd)
+
+    def _pack(self, position, timestamp, channel_id, length, captured, direction):
+        struct.pack_into(
+            RECORD_FORMAT, self._map, CAPTURE_HEADER_SIZE + position,
+            timestamp, channel_id, length, captured, direction
+        )
+
+    def _reclaim(self, size):
+        # drop the oldest records until [head, head + size) is free
+        while self._used and self._head <= self._tail < self._head + size:
+            skip = _record_size(self._map, self._capacity, self._tail)
+            if skip >= RECORD_SIZE and self._map[CAPTURE_HEADER_SIZE + self._tail + 20] != Direction.PAD:
+                self._records -= 1
+
+            self._tail = (self._tail + skip) % self._capacity
+            self._used -= skip
+
+    def _sync(self):
+        struct.pack_into(
+            CAPTURE_HEADER_FORMAT, self._map, 0, CAPTURE_MAGIC, CAPTURE_VERSION, self._capacity,
+            self._head, self._tail, self._used, self._records, self._dropped, self._started
+        )
+
+
+def _record_size(buffer, capacity, position):
+    if capacity - position < RECORD_SIZE:
+        # too short for a record header, the writer wrapped around here
+        return capacity - position
+
+    captured, = struct.unpack_from('<I', buffer, CAPTURE_HEADER_SIZE + position + 16)
+    return RECORD_SIZE + captured
+
+
+def read_capture(path):
+    """
+    Yields the records of a capture file, oldest first.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic, version, capacity, head, tail, used, records, dropped, started = struct.unpack_from(
+        CAPTURE_HEADER_FORMAT, data
+    )
+
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        raise ValueError('{0} is not a capture file'.format(path))
+
+    position = tail
+    while used > 0:
+        size = _record_size(data, capacity, position)
+        if size >= RECORD_SIZE:
+            timestamp, channel_id, length, captured, direction = struct.unpack_from(
+                RECORD_FORMAT, data, CAPTURE_HEADER_SIZE + position
+            )
+
+            if direction != Direction.PAD:
+                offset = CAPTURE_HEADER_SIZE + position + RECORD_SIZE
+                yield Record(timestamp, Direction(direction), channel_id, length, data[offset:offset + captured])
+
+        position = (position + size) % capacity
+        used -= size
@@ -25,37 +25,128 @@
 #
 #####################################################################
 
+import collections
 import enum
+import io
 import logging
+import os
+import socket
+import struct
+import sys
 import threading
-from msock.ringbuffer import RingBuffer
+import time
+from msock.buffers import BufferPolicy
+from msock.compression import get_codec
+from msock.ringbuffer import SPSCRingBuffer
+from msock.shm import SharedSegment
+from msock.utils import Ancillary, FileRegion
 
 
 KEEPALIVE_INTERVAL = 30
+KEEPALIVE_TIMEOUT = 90
+COMPRESSION_THRESHOLD = 128
+COALESCE_SIZE = 16384
+# SCM_RIGHTS limit of the Linux kernel
+MAX_FDS = 253
 
 
 class ChannelType(enum.Enum):
     CONTROL = 'control'
     DATA = 'data'
+    MESSAGE = 'message'
+
+
+class Priority(enum.IntEnum):
+    CONTROL = 0
+    HIGH = 1
+    NORMAL = 2
+    BULK = 3
+
+
+class FileTransfer(object):
+    def __init__(self, fd, offset, count):
+        self.fd = fd
+        self.offset = offset
+        self.remaining = count
+        self.unsent = count
+        self.done = threading.Event()
+
+    def sent(self, nbytes):
+        self.unsent -= nbytes
+        if not self.unsent:
+            self.done.set()
 
 
 class Channel(object):
-    def __init__(self, connection, id, type=ChannelType.DATA, bufsize=4096):
+    def __init__(self, connection, id, type=ChannelType.DATA, bufsize=None, policy=None, compression=None,
+                 priority=None, weight=1):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._id = id
         self._type = type
+        if priority is None:
+            priority = Priority.CONTROL if type == ChannelType.CONTROL else Priority.NORMAL
+
+        if weight < 1:
+            raise ValueError('Channel weight must be at least 1')
+
+        self._priority = Priority(priority)
+        self._weight = weight
         self._connection = connection
         self._closed = False
-        self._recvq = RingBuffer(bufsize)
-        self._sendq = RingBuffer(bufsize)
+        self._codec = get_codec(compression) if compression else None
+        if compression and not self._codec:
+            raise RuntimeError('Unsupported compression {0}'.format(compression))
 
-        self._send_thread = threading.Thread(
-            target=self._worker,
-            name='channel{0} send thread'.format(self.id),
-            daemon=True
-        )
-
-        self._send_thread.start()
+        self._compress = None
+        self._decompress = None
+        self.handler = None
+        self.compression_threshold = COMPRESSION_THRESHOLD
+        self.coalesce_delay = 0
+        self.coalesce_size = COALESCE_SIZE
+        self._policy = policy or (BufferPolicy(bufsize) if bufsize else connection.channel_policy)
+        self._budget = connection.memory_budget
+        self._metrics = connection.metrics.channel(self) if connection.metrics is not None else None
+        self._reserved = 0
+        self._reserve(2 * self._policy.initial, True)
+        # on shm:// the receive ring lives in shared memory and the peer writes right into it
+        self._segments = {}
+        self._generation = 0
+        self._peer_segment = None
+        self._peer_position = 0
+        shared = connection.shm and type == ChannelType.DATA
+        self._recvq = SPSCRingBuffer(self._policy.initial, self._allocate_segment if shared else bytearray)
+        self._sendq = SPSCRingBuffer(self._policy.initial)
+        self._credit = 0
+        self._acked = 0
+        self._credit_lock = threading.Lock()
+        self._window = self._recvq.size - 1
+        self._granted = 0
+        self._received = 0
+        self._unacked = 0
+        self._unacked_lock = threading.Lock()
+        self._last_limited = time.monotonic()
+        self._pending_resize = None
+        self._revoking = False
+        self._inflight = 0
+        self._eof_queued = False
+        self._flushed = threading.Event()
+        self._outgoing = collections.deque()
+        self._outgoing_size = 0
+        self._outgoing_cv = threading.Condition()
+        self._cursor = 0
+        self._offset = 0
+        self._committed = 0
+        self._incoming = collections.deque()
+        self._incoming_cv = threading.Condition()
+        self._fragments = []
+        self._held = 0
+        self._files = collections.deque()
+        self._fds_out = collections.deque()
+        self._fds_in = collections.deque()
+        self._fds_cv = threading.Condition()
+        self._sink = None
+        self._sink_busy = False
+        self._sink_cv = threading.Condition()
 
     @property
     def connection(self):
@@ -73,43 +164,820 @@ class Channel(object):
     def id(self):
         return self._id
 
-    def on_data(self, data):
-        if data == b'':
+    @property
+    def priority(self):
+        return self._priority
+
+    @property
+    def weight(self):
+        return self._weight
+
+    @property
+    def policy(self):
+        return self._policy
+
+    @property
+    def window(self):
+        return self._window
+
+    @property
+    def memory_usage(self):
+        return self._recvq.size + self._sendq.size
+
+    @property
+    def compression(self):
+        return self._codec.name if self._compress else None
+
+    def on_data(self, data, compressed=False, end=False):
+        if data == b'' and not end:
             self._logger.debug('Channel {0} closed'.format(self._id))
             self._recvq.close()
+            with self._incoming_cv:
+                self._incoming_cv.notify_all()
+
+            with self._sink_cv:
+                self._sink_cv.notify()
+
+            return
+
+        if compressed:
+            if self._decompress is None:
+                self._logger.warning('Compressed data on channel {0} without negotiation, discarding'.format(self._id))
+                return
+
+            # credit bounds what the peer may send uncompressed, anything beyond that is a bomb
+            limit = self._recvq.avail_space
+            data = self._decompress(data, limit + 1)
+            if len(data) > limit:
+                self._logger.warning('Channel {0} decompressed data exceeds the receive window, discarding'.format(self._id))
+                return
+
+        if self._metrics is not None:
+            self._metrics.frames_in += 1
+            self._metrics.bytes_in += len(data)
+
+        if self._type == ChannelType.MESSAGE:
+            self._on_fragment(data, end)
+            return
+
+        if self.handler is not None:
+            # push mode: hand the payload over instead of queueing it, any result is the reply
+            self._received += len(data)
+            self._recvq.skip(len(data))
+            reply = self._connection.dispatcher.call(self.handler, data)
+            self._consumed(len(data))
+            if reply:
+                self.write(reply)
+
+            return
+
+        if self._sink is not None:
+            data = self._fill_sink(data)
+            if not data:
+                return
+
+        if len(data) > self._recvq.avail_space:
+            # peer ignored the credit we have granted; never block the recv thread on it
+            self._logger.warning('Channel {0} receive window exceeded, discarding'.format(self._id))
+            return
+
+        if self._pending_resize is not None:
+            with self._unacked_lock:
+                if self._pending_resize is not None:
+                    self._apply_resize()
+
+        self._recvq.write(data)
+        self._received += len(data)
+        if self._metrics is not None:
+            self._metrics.recvq_high_water = max(self._metrics.recvq_high_water, self._recvq.used_space)
+
+        if self._sink is not None:
+            # a reader showed up in recv_into() while we were queueing, it has to drain recvq first
+            with self._sink_cv:
+                self._sink_cv.notify()
+
+    def on_shm_data(self, segment, position, nbytes):
+        for i in [i for i in list(self._segments) if i < segment.generation]:
+            # the peer has moved on to a newer ring, nothing points into the older ones anymore
+            del self._segments[i]
+
+        if self._pending_resize is not None:
+            with self._unacked_lock:
+                if self._pending_resize is not None:
+                    self._apply_resize()
+
+        if self.handler is not None or not self._recvq.produce(segment.mmap, position, nbytes):
+            # the ring has moved since the peer wrote this, or the payload doesn't get queued at all
+            self.on_data(segment.read(position, nbytes))
+            return
+
+        self._received += nbytes
+        if self._metrics is not None:
+            self._metrics.frames_in += 1
+            self._metrics.bytes_in += nbytes
+            self._metrics.recvq_high_water = max(self._metrics.recvq_high_water, self._recvq.used_space)
+
+        if self._sink is not None:
+            # a reader waiting in recv_into() copies it from the ring, that's no worse than a sink
+            with self._sink_cv:
+                self._sink_cv.notify()
+
+    def on_segment(self, segment):
+        # the peer's receive ring, the writer copies payloads straight into it from now on
+        self._peer_segment = segment
+
+    def on_window_update(self, credit):
+        with self._credit_lock:
+            self._credit += credit
+            self._acked += credit
+
+        self._connection.schedule(self)
+
+    def on_window_shrink(self, credit):
+        # the peer wants back credit we haven't used yet, it tells how much it got in return
+        with self._credit_lock:
+            credit = min(credit, max(self._credit, 0))
+            self._credit -= credit
+
+        self._connection.send_window_return(self._id, credit)
+
+    def on_window_return(self, credit):
+        with self._unacked_lock:
+            self._revoking = False
+            self._granted -= credit
+            self._window -= credit
+            new = max(self._policy.minimum, self._recvq.size // 2)
+            if self._window == new - 1:
+                # whatever the peer may still send fits the smaller ring, whose lock orders the copy
+                self._pending_resize = new
+                self._apply_resize()
+
+    def on_compression(self, codec_id):
+        codec = get_codec(codec_id)
+        if codec is None:
+            self._logger.warning('Peer requested unsupported compression {0} on channel {1}'.format(codec_id, self._id))
             return
 
-        self._logger.debug('Read on recvq: {0}'.format(data))
-        self._recvq.writeall(data)
+        self._decompress = codec.decompressor()
+        if self._codec is None:
+            # we didn't ask for compression ourselves, but the peer wants it, so go along
+            self._codec = codec
+            self._connection.send_compression(self._id, codec.id)
+
+        if self._codec.id == codec.id:
+            # our own instance, it carries the level we were configured with
+            self._compress = self._codec.compressor()
+
+    def on_fds(self, fds):
+        with self._fds_cv:
+            if self._recvq.closed:
+                self._logger.warning('File descriptors for closed channel {0}, closing them'.format(self._id))
+                for i in fds:
+                    os.close(i)
+
+                return
+
+            self._fds_in.append(fds)
+            self._fds_cv.notify()
+
+    def on_connection_closed(self):
+        self._closed = True
+        self._sendq.close()
+        self._recvq.close()
+        self._flushed.set()
+        with self._outgoing_cv:
+            self._outgoing_cv.notify_all()
+
+        with self._incoming_cv:
+            self._incoming_cv.notify_all()
+
+        with self._sink_cv:
+            self._sink_cv.notify()
+
+        with self._fds_cv:
+            self._fds_cv.notify_all()
+
+        for i in list(self._files):
+            i.done.set()
+
+        self._close_fds()
+
+        self.release_memory()
+
+    def release_memory(self):
+        if self._budget and self._reserved:
+            self._budget.release(self._reserved)
+
+        self._reserved = 0
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
 
     def read1(self, nbytes):
-        return self._recvq.read(nbytes)
+        return self.recv(nbytes)
 
     def recv(self, nbytes):
-        return self._recvq.read(nbytes)
+        self._check_stream()
+        data = self._recvq.read(nbytes)
+        self._consumed(len(data))
+        return data
+
+    def readinto(self, buffer):
+        self._check_stream()
+        nbytes = self._recvq.read_into(buffer)
+        self._consumed(nbytes)
+        return nbytes
+
+    def recv_into(self, buffer):
+        """
+        Fills the buffer (or an mmap) from the stream, returning less only at EOF.
+        While it waits, whole frames are received straight into the buffer instead
+        of going through the receive queue.
+        """
+        self._check_stream()
+        view = memoryview(buffer).cast('B')
+        done = 0
+        while done < len(view):
+            if self._recvq.used_space:
+                done += self.readinto(view[done:])
+                continue
+
+            with self._sink_cv:
+                if self._recvq.used_space:
+                    continue
+
+                if self._recvq.closed:
+                    break
+
+                self._sink = view[done:]
+                # a frame being received straight into the buffer has to land before we give it back
+                self._sink_cv.wait_for(lambda: not self._sink_busy and (
+                    not len(self._sink) or self._recvq.used_space or self._recvq.closed
+                ))
+                done = len(view) - len(self._sink)
+                self._sink = None
+
+        return done
 
-    def read(self, nbytes):
-        return self._recvq.readall(nbytes)
+    def read(self, nbytes=-1):
+        if nbytes < 0:
+            return self.readall()
+
+        # credit goes back chunk by chunk, a read larger than the window never completes otherwise
+        result = bytearray(nbytes)
+        view = memoryview(result)
+        done = 0
+        while done < nbytes:
+            ret = self.readinto(view[done:])
+            if ret == 0:
+                break
+
+            done += ret
+
+        return bytes(view[:done])
+
+    def readall(self):
+        result = bytearray()
+        while True:
+            data = self.recv(self.window)
+            if data == b'':
+                return bytes(result)
+
+            result += data
 
     def write(self, buffer):
-        self._sendq.writeall(buffer)
+        self._check_stream()
+        view = memoryview(buffer).cast('B')
+        done = 0
+        while done < len(view):
+            ret = self._sendq.write(view[done:])
+            if ret == 0:
+                break
+
+            done += ret
+            self._schedule_write(self._sendq.used_space)
+            if self._metrics is not None:
+                self._metrics.sendq_high_water = max(self._metrics.sendq_high_water, self._sendq.used_space)
+
+        return done
+
+    def sendfile(self, file, offset=0, count=None):
+        # file data follows anything written before; the connection writer sends it with sendfile()
+        if self._type == ChannelType.MESSAGE:
+            raise RuntimeError('Channel {0} is a message channel'.format(self._id))
+
+        try:
+            fd = file.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return self._sendfile_copy(file, offset, count)
+
+        if count is None:
+            count = os.fstat(fd).st_size - offset
+
+        if count <= 0:
+            return 0
+
+        transfer = FileTransfer(fd, offset, count)
+        with self._credit_lock:
+            self._files.append(transfer)
+
+        self._connection.schedule(self)
+        transfer.done.wait()
+        with self._credit_lock:
+            self._files.remove(transfer)
+
+        return count - transfer.unsent
+
+    def send_fds(self, fds):
+        """
+        Passes file descriptors to the peer, in order with the data written around them.
+        They are duplicated first, so the caller is free to close its own copies right away.
+        """
+        if self._type == ChannelType.MESSAGE:
+            raise RuntimeError('Channel {0} is a message channel'.format(self._id))
+
+        if self._connection.family != socket.AF_UNIX:
+            raise RuntimeError('File descriptors can only be passed over unix:// connections')
+
+        if not fds:
+            return
+
+        if len(fds) > MAX_FDS:
+            raise ValueError('At most {0} file descriptors can be passed at once'.format(MAX_FDS))
+
+        dups = [os.dup(i) for i in fds]
+        with self._credit_lock:
+            self._fds_out.append((self._sendq.tail, dups))
+
+        self._connection.schedule(self)
+
+    def recv_fds(self):
+        """
+        Returns the next batch of file descriptors passed by the peer, or None at EOF.
+        The caller owns them and is responsible for closing them.
+        """
+        with self._fds_cv:
+            self._fds_cv.wait_for(lambda: self._fds_in or self._recvq.closed)
+            if not self._fds_in:
+                return None
+
+            return self._fds_in.popleft()
+
+    def writev(self, buffers):
+        if self._type == ChannelType.MESSAGE:
+            return self._queue_message(buffers)
+
+        done = 0
+        for buffer in buffers:
+            view = memoryview(buffer).cast('B')
+            offset = 0
+            while offset < len(view):
+                ret = self._sendq.write(view[offset:])
+                if ret == 0:
+                    return done
+
+                offset += ret
+                done += ret
+                # the next write may block on a full queue, the writer has to know about this one
+                self._schedule_write(self._sendq.used_space)
+
+        if self._metrics is not None:
+            self._metrics.sendq_high_water = max(self._metrics.sendq_high_water, self._sendq.used_space)
+
+        return done
+
+    def flush(self):
+        # sends whatever coalescing is holding back and waits until it is on the wire
+        self._connection.schedule(self)
+        if self._type != ChannelType.MESSAGE:
+            self._sendq.wait_drained()
+            return
+
+        with self._outgoing_cv:
+            self._outgoing_cv.wait_for(lambda: not self._outgoing or self._sendq.closed)
 
     def send(self, buffer):
-        return self._sendq.write(buffer)
+        self._check_stream()
+        ret = self._sendq.write(buffer)
+        self._schedule_write(self._sendq.used_space)
+        if self._metrics is not None:
+            self._metrics.sendq_high_water = max(self._metrics.sendq_high_water, self._sendq.used_space)
+
+        return ret
+
+    def send_message(self, buffer):
+        if self._type != ChannelType.MESSAGE:
+            raise RuntimeError('Channel {0} is not a message channel'.format(self._id))
+
+        return self._queue_message((buffer,))
+
+    def recv_message(self):
+        if self._type != ChannelType.MESSAGE:
+            raise RuntimeError('Channel {0} is not a message channel'.format(self._id))
+
+        with self._incoming_cv:
+            self._incoming_cv.wait_for(lambda: self._incoming or self._recvq.closed)
+            if not self._incoming:
+                return None
+
+            message = self._incoming.popleft()
+            nbytes = self._held if not self._incoming else min(self._held, len(message))
+            self._held -= nbytes
+
+        self._consumed(nbytes)
+        return message
 
     def close(self):
         self._closed = True
         self._logger.debug('Cleaning up resources associated with channel {0}'.format(self._id))
         self._sendq.close()
-        self._send_thread.join()
+        if self._connection.closed or sys.is_finalizing():
+            # no writer left to flush what is queued, e.g. a wrapper finalized at exit
+            return
 
-    def _worker(self):
-        while True:
-            data = self._sendq.read(1024)
-            self._logger.debug('Read on sendq: {0}'.format(data))
-            self._connection.send(self.id, data)
-            if data == b'':
-                self._logger.debug('EOF received on channel {0}, closing'.format(self._id))
-                self._sendq.close()
-                self._recvq.close()
+        self._connection.schedule(self)
+        self._flushed.wait()
+
+    def _check_stream(self):
+        # message channels never drain the byte queues, a stream call would block forever
+        if self._type == ChannelType.MESSAGE:
+            raise RuntimeError('Channel {0} is a message channel'.format(self._id))
+
+    def _reserve(self, nbytes, force=False):
+        if self._budget and not self._budget.reserve(nbytes):
+            if force:
+                raise RuntimeError('Memory budget exhausted, cannot allocate channel {0}'.format(self._id))
+
+            return False
+
+        self._reserved += nbytes
+        return True
+
+    def _release(self, nbytes):
+        if self._budget:
+            self._budget.release(nbytes)
+
+        self._reserved -= nbytes
+
+    def _open(self):
+        self._grant(self._window)
+        if self._codec:
+            self._connection.send_compression(self._id, self._codec.id)
+
+    def _grant(self, credit):
+        with self._unacked_lock:
+            self._granted += credit
+
+        self._connection.send_window_update(self._id, credit)
+
+    def _resize_window(self):
+        # every byte of the window is either queued in recvq, still granted to the peer or
+        # consumed but not yet returned, so the window can only shrink by withholding credit
+        policy = self._policy
+        size = self._recvq.size
+        now = time.monotonic()
+
+        if self._granted == self._received:
+            # the peer has used up all of its credit: it is sending faster than we read,
+            # and since it can't send anything more the recv thread won't touch recvq
+            self._last_limited = now
+            new = min(policy.maximum, size * 2)
+            if new > size and self._reserve(new - size):
+                self._pending_resize = None
+                self._recvq.resize(new)
+                self._unacked += new - 1 - self._window
+                self._window = new - 1
+                # an idle channel has to shrink back even when nothing calls _consumed() anymore
+                self._connection.watch_windows()
+
+            return 0
+
+        if self._revoking or size <= policy.minimum or now - self._last_limited < policy.idle_timeout:
+            return 0
+
+        new = max(policy.minimum, size // 2)
+        excess = min(self._window - (new - 1), self._unacked)
+        self._window -= excess
+        self._unacked -= excess
+        if self._window == new - 1:
+            # recvq is only resized by its producer, or once the peer has run out of credit
+            self._pending_resize = new
+            if self._granted == self._received:
+                self._apply_resize()
+
+            return 0
+
+        # the rest is credit the peer holds, on_window_return() finishes the job
+        self._revoking = True
+        return self._window - (new - 1)
+
+    def _shrink_idle(self, now):
+        # called from the keepalive thread, returns when the channel wants to be looked at again
+        policy = self._policy
+        with self._unacked_lock:
+            if self._closed or self._recvq.size <= policy.minimum:
+                return None
+
+            revoke = self._resize_window() or None
+            if self._pending_resize is not None and self._granted == self._received:
+                # an idle peer never sends the frame that would apply it
+                self._apply_resize()
+            elif self._pending_resize is not None and not self._revoking:
+                # one still holding credit may be sending right now, so only the recv thread
+                # may resize: on_window_return() does it once the empty request is answered
+                self._revoking = True
+                revoke = 0
+
+            due = self._last_limited + policy.idle_timeout
+
+        if revoke is not None:
+            self._connection.send_window_shrink(self._id, revoke)
+
+        return due if due > now else now + policy.idle_timeout
+
+    def _allocate_segment(self, size):
+        # every ring gets a segment of its own, the peer keeps writing to the old one until
+        # it has learned about the new one, which is why on_shm_data() can still find them
+        self._generation += 1
+        segment, fd = SharedSegment.create(size, self._generation)
+        self._segments[self._generation] = segment
+        self._connection.send_segment(self._id, self._generation, fd)
+        return segment.mmap
+
+    def _apply_resize(self):
+        size = self._recvq.size
+        self._recvq.resize(self._pending_resize)
+        self._release(size - self._pending_resize)
+        self._pending_resize = None
+        self._last_limited = time.monotonic()
+
+    def _consumed(self, nbytes):
+        revoke = credit = 0
+        with self._unacked_lock:
+            self._unacked += nbytes
+            if self._policy.growable:
+                revoke = self._resize_window()
+
+            if self._unacked >= self._window // 4:
+                credit = self._unacked
+                self._granted += credit
+                self._unacked = 0
+
+        if revoke:
+            self._connection.send_window_shrink(self._id, revoke)
+
+        if credit:
+            self._connection.send_window_update(self._id, credit)
+
+    def _on_fragment(self, data, end):
+        self._fragments.append(bytes(data))
+        with self._incoming_cv:
+            self._received += len(data)
+            if end:
+                message = self._fragments[0] if len(self._fragments) == 1 else b''.join(self._fragments)
+                self._fragments = []
+                self._incoming.append(message)
+                self._held += len(data)
+                self._incoming_cv.notify()
                 return
+
+            if self._incoming:
+                # the reader is behind, stop granting until it catches up
+                self._held += len(data)
+                return
+
+        # a message still being assembled with nothing else queued: keep the peer sending
+        self._consumed(len(data))
+
+    def _sendfile_copy(self, file, offset, count):
+        file.seek(offset)
+        done = 0
+        while count is None or done < count:
+            data = file.read(self._sendq.size if count is None else min(self._sendq.size, count - done))
+            if not data:
+                break
+
+            done += self.write(data)
+
+        return done
+
+    def _fill_sink(self, data):
+        # called by the producer, returns what didn't fit and has to be queued
+        with self._sink_cv:
+            sink = self._sink
+            if sink is None or not len(sink) or self._recvq.used_space:
+                return data
+
+            nbytes = min(len(sink), len(data))
+            sink[:nbytes] = data[:nbytes]
+            self._sink = sink[nbytes:]
+            self._received += nbytes
+            self._recvq.skip(nbytes)
+            self._sink_cv.notify()
+
+        self._consumed(nbytes)
+        return data[nbytes:]
+
+    def _claim_sink(self, nbytes):
+        # the recv thread wants to land a whole frame in the reader's buffer
+        with self._sink_cv:
+            sink = self._sink
+            if sink is None or len(sink) < nbytes or self._recvq.used_space or self._recvq.closed:
+                return None
+
+            # the reader keeps waiting until _sink_filled(), even if the channel goes away meanwhile
+            self._sink_busy = True
+            return sink[:nbytes]
+
+    def _sink_filled(self, nbytes):
+        # nbytes is 0 when the frame couldn't be received completely
+        with self._sink_cv:
+            self._sink_busy = False
+            self._sink_cv.notify()
+            if self._sink is None or not nbytes:
+                return
+
+            self._sink = self._sink[nbytes:]
+            self._received += nbytes
+            self._recvq.skip(nbytes)
+            if self._recvq.closed or self._connection.channels.get(self._id) is not self:
+                # destroyed while the frame was on its way, no credit goes back for it
+                return
+
+        if self._metrics is not None:
+            self._metrics.frames_in += 1
+            self._metrics.bytes_in += nbytes
+
+        self._consumed(nbytes)
+
+    def _next_fds_frame(self):
+        with self._credit_lock:
+            position, fds = self._fds_out.popleft()
+
+        # the payload only tells the peer how many descriptors to take off the socket
+        return Ancillary(struct.pack('I', len(fds)), fds, lambda: self._close_fds(fds)), 0, False, False
+
+    def _close_fds(self, fds=None):
+        if fds is not None:
+            for i in fds:
+                os.close(i)
+
+            return
+
+        with self._credit_lock:
+            pending = [i for position, fds in self._fds_out for i in fds]
+            self._fds_out.clear()
+
+        with self._fds_cv:
+            pending += [i for fds in self._fds_in for i in fds]
+            self._fds_in.clear()
+
+        for i in pending:
+            os.close(i)
+
+    def _next_file_frame(self, maxsize):
+        with self._credit_lock:
+            transfer = next((i for i in self._files if i.remaining), None)
+            if transfer is None or self._credit <= 0:
+                return None
+
+            nbytes = min(transfer.remaining, self._credit, maxsize)
+            region = FileRegion(transfer.fd, transfer.offset, nbytes, transfer.sent)
+            transfer.offset += nbytes
+            transfer.remaining -= nbytes
+            self._credit -= nbytes
+
+        return region, nbytes, False, False
+
+    def _queue_message(self, buffers):
+        # buffers are referenced, not copied, so they must not change until they have been sent
+        views = [memoryview(i).cast('B') for i in buffers]
+        parts = [i for i in views if len(i)] or views[:1] or [memoryview(b'')]
+        nbytes = sum(len(i) for i in parts)
+        with self._outgoing_cv:
+            # don't let the sender run further ahead of the wire than a send queue would
+            self._outgoing_cv.wait_for(lambda: self._outgoing_size < self._sendq.size or self._sendq.closed)
+            if self._sendq.closed:
+                return 0
+
+            # a message goes out as one run of frames per part, the last one carrying FRAME_END
+            for i in parts[:-1]:
+                self._outgoing.append((i, False))
+
+            self._outgoing.append((parts[-1], True))
+            self._outgoing_size += nbytes
+            queued = self._outgoing_size
+
+        self._schedule_write(queued)
+        return nbytes
+
+    def _schedule_write(self, queued):
+        # with coalescing on, small writes wait for company until the delay runs out
+        if self.coalesce_delay and queued < min(self.coalesce_size, self._sendq.size // 2):
+            self._connection.schedule(self, self.coalesce_delay)
+            return
+
+        self._connection.schedule(self)
+
+    def _next_message_frame(self, maxsize):
+        with self._credit_lock:
+            part, last = self._outgoing[self._cursor]
+            nbytes = min(len(part) - self._offset, self._credit, maxsize)
+            if nbytes <= 0 and len(part):
+                return None
+
+            data = part[self._offset:self._offset + nbytes]
+            self._credit -= nbytes
+            self._offset += nbytes
+
+        end = False
+        if self._offset == len(part):
+            end = last
+            self._cursor += 1
+            self._offset = 0
+
+        if self._compress and nbytes >= self.compression_threshold:
+            return self._compress(data), nbytes, True, end
+
+        return data, nbytes, False, end
+
+    def _next_frame(self, maxsize):
+        # called by the connection writer, which is the only consumer of the send queue
+        if self._eof_queued:
+            return None
+
+        if self._type == ChannelType.MESSAGE:
+            pending = self._cursor < len(self._outgoing)
+        else:
+            pending = self._sendq.used_space > self._inflight
+
+        if self._fds_out and self._fds_out[0][0] <= self._sendq.head + self._inflight:
+            # everything written before these descriptors is on its way
+            return self._next_fds_frame()
+
+        if not pending and self._files:
+            return self._next_file_frame(maxsize)
+
+        if not pending:
+            if not self._sendq.closed:
+                return None
+
+            self._logger.debug('EOF received on channel {0}, closing'.format(self._id))
+            self._eof_queued = True
+            self._recvq.close()
+            return b'', 0, False, False
+
+        if self._type == ChannelType.MESSAGE:
+            return self._next_message_frame(maxsize)
+
+        with self._credit_lock:
+            if self._credit <= 0:
+                return None
+
+            # hand out a view past the data already queued for sending, no copies
+            limit = min(self._credit, maxsize)
+            if self._fds_out:
+                # stop right where descriptors have to go in between
+                limit = min(limit, self._fds_out[0][0] - self._sendq.head - self._inflight)
+
+            skip = self._inflight
+            for data in self._sendq.peek(skip + limit):
+                if skip < len(data):
+                    data = data[skip:]
+                    nbytes = len(data)
+                    self._inflight += nbytes
+                    self._credit -= nbytes
+                    break
+
+                skip -= len(data)
+            else:
+                return None
+
+        # credit is always accounted in uncompressed bytes, that's what lands in the peer's recvq
+        if self._compress and nbytes >= self.compression_threshold:
+            return self._compress(data), nbytes, True, False
+
+        return data, nbytes, False, False
+
+    def _frame_sent(self, nbytes, end=False):
+        if self._type != ChannelType.MESSAGE:
+            self._sendq.commit(nbytes)
+            self._inflight -= nbytes
+            return
+
+        with self._outgoing_cv:
+            # frames go out in order and never span two parts, so this one belongs to the oldest
+            self._outgoing_size -= nbytes
+            self._committed += nbytes
+            if self._committed == len(self._outgoing[0][0]):
+                self._outgoing.popleft()
+                self._cursor -= 1
+                self._committed = 0
+
+            self._outgoing_cv.notify_all()
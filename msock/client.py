@@ -25,19 +25,65 @@
 #
 #####################################################################
 
+import array
+import collections
+import contextlib
+import enum
 import errno
+import heapq
+import itertools
 import logging
+import os
 import socket
 import threading
+import time
 import struct
-import urllib.parse
-from msock.channel import Channel
-from msock.utils import recvall
+from msock.buffers import BufferPolicy
+from msock.capture import Direction
+from msock.channel import Channel, ChannelType, Priority, KEEPALIVE_INTERVAL, KEEPALIVE_TIMEOUT, MAX_FDS
+from msock.dispatch import Dispatcher
+from msock.ids import ChannelIdAllocator
+from msock.keepalive import DEFAULT_KEEPALIVE
+from msock.shm import SharedSegment, SHM_BUFFER_POLICY
+from msock.utils import Ancillary, FileRegion, sendframes, parse_uri
 
 
 HEADER_MAGIC = 0x5a5a5a5a
 HEADER_FORMAT = 'III'
 HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+FRAME_COMPRESSED = 0x80000000
+FRAME_END = 0x40000000
+FRAME_FDS = 0x20000000
+FRAME_SHM = 0x10000000
+FRAME_LENGTH_MASK = 0x0fffffff
+CONTROL_CHANNEL = 0
+CONTROL_FORMAT = 'III'
+CONTROL_SIZE = struct.calcsize(CONTROL_FORMAT)
+MAX_FRAME_SIZE = 16384
+SEND_BATCH_FRAMES = 64
+SEND_BATCH_SIZE = 256 * 1024
+RECV_BUFFER_SIZE = 256 * 1024
+# generation of the segment, payload length and its position in the peer's receive ring
+SHM_DOORBELL_FORMAT = 'IIQ'
+SHM_DOORBELL_SIZE = struct.calcsize(SHM_DOORBELL_FORMAT)
+FDS_ITEMSIZE = array.array('i').itemsize
+
+
+class ControlCommand(enum.IntEnum):
+    WINDOW_UPDATE = 1
+    COMPRESSION = 2
+    OPEN = 3
+    CLOSE = 4
+    PING = 5
+    PONG = 6
+    WINDOW_SHRINK = 7
+    WINDOW_RETURN = 8
+    # only ever sent with the segment descriptor attached, see send_segment()
+    SEGMENT = 9
+
+
+# OPEN carries the channel type as an index into this
+CHANNEL_TYPES = tuple(ChannelType)
 
 
 class Connection(object):
@@ -46,12 +92,47 @@ class Connection(object):
         self.on_channel_created = lambda chan: None
         self.on_channel_destroyed = lambda chan: None
         self.on_closed = lambda: None
-        self.channel_factory = lambda id: Channel(self, id)
+        self.channel_factory = lambda id, **kwargs: Channel(self, id, **kwargs)
+        self.buffer_policy = BufferPolicy()
+        self.memory_budget = None
+        self.dispatcher = Dispatcher()
+        self.max_frame_size = MAX_FRAME_SIZE
+        self.metrics = None
+        self.capture = None
+        self.shm = False
+        self.shm_buffer_policy = SHM_BUFFER_POLICY
+        self.nodelay = True
+        self.cork = True
+        self.channel_ids = ChannelIdAllocator()
+        self.accept_channels = False
+        self.keepalive_interval = KEEPALIVE_INTERVAL
+        self.keepalive_timeout = KEEPALIVE_TIMEOUT
+        self.idle_timeout = None
+        self.channel_idle_timeout = None
         self._channels = {}
+        self._closing = set()
+        self._pending_control = {}
         self._recv_thread = None
+        self._send_thread = None
+        self._send_cv = threading.Condition()
+        self._ready = [collections.OrderedDict() for i in Priority]
+        self._control = collections.deque()
+        self._deferred = {}
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._corkable = False
         self._address = None
         self._socket = None
         self._closed = False
+        self._fds = collections.deque()
+        self._rtt = None
+        self._ping_seq = 0
+        self._ping_sent = None
+        self._last_ping = None
+        self._last_recv = 0
+        self._last_active = 0
+        self._activity = {}
+        self._on_lost = lambda: None
         self._lock = threading.RLock()
 
     @property
@@ -62,83 +143,888 @@ class Connection(object):
     def remote_address(self):
         return self._address
 
-    def create_channel(self, id=None):
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def rtt(self):
+        # smoothed the way TCP does it, None until the first pong came back
+        return self._rtt
+
+    @property
+    def channel_policy(self):
+        # what channels created without an explicit policy get
+        return self.shm_buffer_policy if self.shm else self.buffer_policy
+
+    @property
+    def family(self):
+        return self._socket.family if self._socket else None
+
+    def fileno(self):
+        return self._socket.fileno() if self._socket else -1
+
+    def create_channel(self, id=None, policy=None, compression=None, type=None, priority=None, weight=None):
+        if self._closed:
+            raise RuntimeError('Connection is closed')
+
         if id is None:
-            id = max(self.channels.keys()) + 1
+            id = self.channel_ids.allocate(self._channel_in_use)
+
+        if id == CONTROL_CHANNEL:
+            raise RuntimeError('Channel {0} is reserved for control frames'.format(id))
 
-        chan = self.channel_factory(id)
-        self._channels[id] = chan
+        if id in self._channels:
+            raise RuntimeError('Channel {0} already exists'.format(id))
+
+        options = {}
+        if type is not None:
+            options['type'] = type
+
+        if policy is not None:
+            options['policy'] = policy
+
+        if compression is not None:
+            options['compression'] = compression
+
+        if priority is not None:
+            options['priority'] = priority
+
+        if weight is not None:
+            options['weight'] = weight
+
+        chan = self._create_channel(id, options)
         self.on_channel_created(chan)
-        logging.debug('Created channel {0}'.format(id))
         return chan
 
     def destroy_channel(self, id):
-        logging.debug('Destroying channel {0}'.format(id))
-        del self._channels[id]
+        self.destroy_channels((id,))
+
+    def destroy_channels(self, ids=None):
+        # tears down many channels at once; every CLOSE goes out in the same batch
+        with self._lock:
+            if ids is None:
+                ids = list(self._channels)
+
+            destroyed = []
+            for id in ids:
+                chan = self._channels.pop(id, None)
+                if chan is not None:
+                    self._closing.add(id)
+                    destroyed.append(chan)
+
+        frames = [self._control_frame(ControlCommand.CLOSE, i.id) for i in destroyed]
+        with self._send_cv:
+            for i in destroyed:
+                self._ready[i.priority].pop(i.id, None)
+
+            if not self._closed:
+                self._control.extend(frames)
+                self._send_cv.notify()
+
+        for i in destroyed:
+            self._logger.debug('Destroying channel {0}'.format(i.id))
+            self._teardown_channel(i)
+
+    def _create_channel(self, id, options):
+        chan = self.channel_factory(id, **options)
+        with self._lock:
+            self._channels[id] = chan
+            pending = self._pending_control.pop(id, [])
+
+        # OPEN has to reach the peer ahead of the window grant from _open()
+        self.send_control(ControlCommand.OPEN, id, CHANNEL_TYPES.index(chan.type))
+        chan._open()
+        for command, argument in pending:
+            self._on_channel_control(chan, command, argument)
+
+        self._logger.debug('Created channel {0}'.format(id))
+        return chan
+
+    def _teardown_channel(self, chan):
+        if self.metrics is not None:
+            self.metrics.channels.pop(chan.id, None)
+
+        self.dispatcher.submit(chan, chan.on_connection_closed)
+        self.dispatcher.submit(chan, self.on_channel_destroyed, chan)
+
+    def _channel_in_use(self, id):
+        # IDs stay taken until the peer acknowledged our CLOSE
+        return id in self._channels or id in self._closing
 
     def open(self):
         self._closed = False
+        self._configure_socket()
+        self._last_recv = self._last_active = time.monotonic()
+        self._ping_sent = self._last_ping = None
+        self._activity.clear()
         self._recv_thread = threading.Thread(target=self._recv, daemon=True, name='msock recv thread')
+        self._send_thread = threading.Thread(target=self._writer, daemon=True, name='msock send thread')
+        # the writer goes first, a connection lost right away joins it when the recv thread tears down
+        self._send_thread.start()
         self._recv_thread.start()
+        if self.keepalive_interval or self.keepalive_timeout or self.idle_timeout or self.channel_idle_timeout:
+            DEFAULT_KEEPALIVE.register(self)
+
+    def schedule(self, chan, delay=None):
+        with self._send_cv:
+            ready = self._ready[chan.priority]
+            if chan.id in ready:
+                return
+
+            if delay:
+                # coalescing: the writer picks the channel up once the delay runs out,
+                # unless something schedules it for real before that
+                if chan.id not in self._deferred:
+                    self._deferred[chan.id] = chan
+                    deadline = time.monotonic() + delay
+                    heapq.heappush(self._timers, (deadline, next(self._timer_seq), chan))
+                    if self._timers[0][2] is chan:
+                        self._send_cv.notify()
+
+                return
+
+            self._deferred.pop(chan.id, None)
+            ready[chan.id] = chan
+            self._send_cv.notify()
 
     def send(self, channel_id, data):
-        if self._closed:
-            return
+        return self.send_many(((channel_id, data),))
+
+    def send_many(self, frames):
+        # frames go through their channel's send queue, so they wait for credit, get split
+        # to max_frame_size and stay behind whatever was queued before; runs of buffers for
+        # the same channel are handed over with a single writev()
+        done = 0
+        for channel_id, group in itertools.groupby(frames, key=lambda frame: frame[0]):
+            chan = self._channels.get(channel_id)
+            if chan is None:
+                raise RuntimeError('Channel {0} does not exist'.format(channel_id))
+
+            buffers = [data for channel_id, data in group]
+            if chan.type == ChannelType.MESSAGE:
+                done += sum(chan.send_message(i) for i in buffers)
+                continue
 
-        header = struct.pack(
-            HEADER_FORMAT,
+            done += chan.writev(buffers)
+
+        return done
+
+    def send_control(self, command, channel_id, argument=0):
+        frame = self._control_frame(command, channel_id, argument)
+        with self._send_cv:
+            if self._closed:
+                return
+
+            self._control.append(frame)
+            self._send_cv.notify()
+
+    def send_window_update(self, channel_id, credit):
+        self.send_control(ControlCommand.WINDOW_UPDATE, channel_id, credit)
+
+    def send_window_shrink(self, channel_id, credit):
+        self.send_control(ControlCommand.WINDOW_SHRINK, channel_id, credit)
+
+    def send_window_return(self, channel_id, credit):
+        self.send_control(ControlCommand.WINDOW_RETURN, channel_id, credit)
+
+    def send_segment(self, channel_id, generation, fd):
+        # a control frame with the descriptor attached, the fd is ours to close
+        header = struct.pack(HEADER_FORMAT, HEADER_MAGIC, CONTROL_CHANNEL, 4 + CONTROL_SIZE | FRAME_FDS)
+        payload = struct.pack('I' + CONTROL_FORMAT, 1, ControlCommand.SEGMENT, channel_id, generation)
+        with self._send_cv:
+            if self._closed:
+                os.close(fd)
+                return
+
+            self._control.append(header)
+            self._control.append(Ancillary(payload, [fd], lambda: os.close(fd)))
+            self._send_cv.notify()
+
+    def watch_windows(self):
+        # grown windows are shrunk back from the heartbeat once they go idle
+        if not self._closed:
+            DEFAULT_KEEPALIVE.register(self)
+
+    def send_compression(self, channel_id, codec_id):
+        self.send_control(ControlCommand.COMPRESSION, channel_id, codec_id)
+
+    def ping(self):
+        self._ping_seq = (self._ping_seq + 1) & 0xffffffff
+        self._ping_sent = self._last_ping = time.monotonic()
+        self.send_control(ControlCommand.PING, CONTROL_CHANNEL, self._ping_seq)
+
+    def _control_frame(self, command, channel_id, argument=0):
+        return struct.pack(
+            HEADER_FORMAT + CONTROL_FORMAT,
             HEADER_MAGIC,
+            CONTROL_CHANNEL,
+            CONTROL_SIZE,
+            command,
             channel_id,
-            len(data)
+            argument
         )
 
+    def _on_control(self, data):
+        if len(data) < CONTROL_SIZE:
+            self._logger.warning('Truncated control frame received, discarding')
+            return
+
+        command, channel_id, argument = struct.unpack_from(CONTROL_FORMAT, data)
+        if command in (ControlCommand.WINDOW_UPDATE, ControlCommand.COMPRESSION):
+            with self._lock:
+                if channel_id in self._closing:
+                    # meant for the instance we destroyed, the peer's CLOSE is the last of those
+                    return
+
+                chan = self._channels.get(channel_id)
+                if chan is None:
+                    # peer opened its end first; replay this once we create ours
+                    self._pending_control.setdefault(channel_id, []).append((command, argument))
+                    return
+
+            if command == ControlCommand.COMPRESSION:
+                # has to take effect in order with the data frames around it
+                self.dispatcher.submit(chan, self._on_channel_control, chan, command, argument)
+                return
+
+            self._on_channel_control(chan, command, argument)
+            return
+
+        if command in (ControlCommand.WINDOW_SHRINK, ControlCommand.WINDOW_RETURN):
+            with self._lock:
+                chan = None if channel_id in self._closing else self._channels.get(channel_id)
+
+            if chan is None:
+                return
+
+            if command == ControlCommand.WINDOW_RETURN:
+                # may resize recvq, so it has to run where the data frames before it are queued
+                self.dispatcher.submit(chan, self._on_channel_control, chan, command, argument)
+                return
+
+            self._on_channel_control(chan, command, argument)
+            return
+
+        if command == ControlCommand.OPEN:
+            self._on_open(channel_id, argument)
+            return
+
+        if command == ControlCommand.CLOSE:
+            self._on_close(channel_id)
+            return
+
+        if command == ControlCommand.PING:
+            self.send_control(ControlCommand.PONG, CONTROL_CHANNEL, argument)
+            return
+
+        if command == ControlCommand.PONG:
+            self._on_pong(argument)
+            return
+
+        self._logger.warning('Unknown control command {0} received, discarding'.format(command))
+
+    def _on_open(self, channel_id, argument):
         with self._lock:
-            try:
-                self._socket.sendall(header)
-                self._socket.sendall(data)
-            except OSError as err:
-                if err.errno == errno.EPIPE:
+            if channel_id in self._channels:
+                return
+
+            if not self.accept_channels or channel_id in self._closing or argument >= len(CHANNEL_TYPES):
+                # the application creates its end explicitly, the pending list just
+                # remembers the channel was opened so a later CLOSE can clean it up
+                self._pending_control.setdefault(channel_id, []).append((ControlCommand.OPEN, argument))
+                return
+
+        # created right here so the data frames following OPEN find the channel
+        try:
+            chan = self._create_channel(channel_id, {'type': CHANNEL_TYPES[argument]})
+        except Exception as err:
+            # refuse it; our CLOSE makes the peer tear its end down and its answer is the ack
+            self._logger.warning('Refusing channel {0} opened by peer: {1}'.format(channel_id, err))
+            with self._lock:
+                self._pending_control.pop(channel_id, None)
+                self._closing.add(channel_id)
+
+            self.send_control(ControlCommand.CLOSE, channel_id)
+            return
+
+        self.dispatcher.submit(chan, self.on_channel_created, chan)
+
+    def _on_close(self, channel_id):
+        with self._lock:
+            self._pending_control.pop(channel_id, None)
+            if channel_id in self._closing:
+                # acknowledgement of our own CLOSE, the ID is free now
+                self._closing.discard(channel_id)
+                self.channel_ids.release(channel_id)
+                return
+
+            chan = self._channels.pop(channel_id, None)
+
+        if chan is not None:
+            self._logger.debug('Channel {0} closed by peer'.format(channel_id))
+            with self._send_cv:
+                self._ready[chan.priority].pop(channel_id, None)
+
+            self._teardown_channel(chan)
+
+        self.send_control(ControlCommand.CLOSE, channel_id)
+        self.channel_ids.release(channel_id)
+
+    def _on_pong(self, seq):
+        sent = self._ping_sent
+        if sent is None or seq != self._ping_seq:
+            # answer to a ping we gave up on already
+            return
+
+        self._ping_sent = None
+        sample = time.monotonic() - sent
+        self._rtt = sample if self._rtt is None else self._rtt + (sample - self._rtt) / 8
+        if self.metrics is not None:
+            self.metrics.rtt.observe(sample)
+
+    def _heartbeat(self, now):
+        # runs on the keepalive thread, returns when it wants to run next
+        if self._closed:
+            return None
+
+        due = []
+        if self.keepalive_timeout:
+            if now - self._last_recv >= self.keepalive_timeout:
+                self._logger.info('Nothing received from {0} for {1:.1f}s, closing'.format(
+                    self._address, now - self._last_recv
+                ))
+                self._abort()
+                return None
+
+            due.append(self._last_recv + self.keepalive_timeout)
+
+        if self.keepalive_interval:
+            last = self._last_ping
+            if last is None or now - last >= self.keepalive_interval:
+                self.ping()
+                last = now
+
+            due.append(last + self.keepalive_interval)
+
+        if self.idle_timeout or self.channel_idle_timeout:
+            due.append(self._reap_idle(now))
+
+        with self._lock:
+            channels = [i for i in self._channels.values() if i.policy.growable]
+
+        for chan in channels:
+            due.append(chan._shrink_idle(now))
+
+        due = [i for i in due if i is not None]
+        return min(due) if due else None
+
+    def _reap_idle(self, now):
+        # activity shows up as bytes received or acknowledged by the peer since the last
+        # scan, so nothing has to be timestamped on the data path
+        with self._lock:
+            channels = list(self._channels.values())
+
+        stale = []
+        activity = {}
+        for chan in channels:
+            signature = (chan._received, chan._acked)
+            previous = self._activity.get(chan.id)
+            if previous is None or previous[1] is not chan or previous[0] != signature:
+                activity[chan.id] = (signature, chan, now)
+                self._last_active = now
+                continue
+
+            activity[chan.id] = previous
+            if self.channel_idle_timeout and now - previous[2] >= self.channel_idle_timeout:
+                stale.append(chan.id)
+
+        self._activity = activity
+        if stale:
+            self._logger.debug('Reaping {0} idle channels'.format(len(stale)))
+            self.destroy_channels(stale)
+
+        if self.idle_timeout and now - self._last_active >= self.idle_timeout:
+            self._logger.info('Connection to {0} idle for {1:.1f}s, closing'.format(
+                self._address, now - self._last_active
+            ))
+            self._abort()
+            return now
+
+        due = [self._last_active + self.idle_timeout] if self.idle_timeout else []
+        if self.channel_idle_timeout:
+            due.extend(since + self.channel_idle_timeout for signature, chan, since in activity.values())
+
+        return min(due) if due else now + self.channel_idle_timeout
+
+    def _abort(self):
+        # wakes both threads, the recv thread then runs the regular teardown
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _on_channel_control(self, chan, command, argument):
+        if command == ControlCommand.OPEN:
+            return
+
+        if command == ControlCommand.WINDOW_UPDATE:
+            chan.on_window_update(argument)
+        elif command == ControlCommand.COMPRESSION:
+            chan.on_compression(argument)
+        elif command == ControlCommand.WINDOW_SHRINK:
+            chan.on_window_shrink(argument)
+        elif command == ControlCommand.WINDOW_RETURN:
+            chan.on_window_return(argument)
+        elif command == ControlCommand.SEGMENT:
+            chan.on_segment(argument)
+
+    def _collect_frames(self):
+        buffers = []
+        sent = []
+        flushed = []
+        size = 0
+
+        while self._control:
+            frame = self._control.popleft()
+            buffers.append(frame)
+            if isinstance(frame, Ancillary):
+                # payload of the descriptor frame whose header was queued right before it
+                continue
+
+            if self.metrics is not None or self.capture is not None:
+                magic, channel_id, length = struct.unpack_from(HEADER_FORMAT, frame)
+                if self.metrics is not None:
+                    self._count_frame_out(length & FRAME_LENGTH_MASK)
+
+                if self.capture is not None:
+                    self._capture_frame(Direction.OUT, channel_id, length, frame[HEADER_SIZE:])
+
+        # strict priority between classes and weighted round-robin within one; batches are
+        # bounded, so a more urgent channel waits at most for the batch already on the wire
+        while len(buffers) < SEND_BATCH_FRAMES * 2 and size < SEND_BATCH_SIZE:
+            for ready in self._ready:
+                if ready:
+                    break
+            else:
+                break
+
+            id, chan = ready.popitem(last=False)
+            nbytes, more = self._collect_channel(chan, buffers, sent, flushed)
+            size += nbytes
+            if more:
+                ready[id] = chan
+
+        return buffers, sent, flushed
+
+    def _collect_channel(self, chan, buffers, sent, flushed):
+        size = 0
+        for i in range(chan.weight):
+            segment = chan._peer_segment
+            frame = chan._next_frame(self.max_frame_size if segment is None else segment.size)
+            if frame is None:
+                return size, False
+
+            data, nbytes, compressed, end = frame
+            length = len(data)
+            if compressed:
+                length |= FRAME_COMPRESSED
+
+            if end:
+                length |= FRAME_END
+
+            # every byte lands in the peer's receive ring, whichever way it goes
+            position = chan._peer_position
+            chan._peer_position += nbytes
+            if segment is not None and nbytes and not compressed and not isinstance(data, FileRegion):
+                # copied right into the peer's receive ring, the socket only carries where it went
+                segment.write(position, data)
+                buffers.append(struct.pack(HEADER_FORMAT, HEADER_MAGIC, chan.id, SHM_DOORBELL_SIZE | FRAME_SHM))
+                buffers.append(struct.pack(SHM_DOORBELL_FORMAT, segment.generation, nbytes, position))
+                size += nbytes
+                sent.append((chan, nbytes, end))
+                if self.metrics is not None:
+                    self._count_frame_out(nbytes)
+                    chan._metrics.frames_out += 1
+                    chan._metrics.bytes_out += nbytes
+
+                if self.capture is not None:
+                    self._capture_frame(Direction.OUT, chan.id, length, data)
+
+                continue
+
+            if isinstance(data, Ancillary):
+                length |= FRAME_FDS
+            elif not nbytes and not end:
+                buffers.append(struct.pack(HEADER_FORMAT, HEADER_MAGIC, chan.id, length))
+                flushed.append(chan)
+                if self.capture is not None:
+                    self._capture_frame(Direction.OUT, chan.id, length)
+
+                return size, False
+
+            buffers.append(struct.pack(HEADER_FORMAT, HEADER_MAGIC, chan.id, length))
+            buffers.append(data)
+            size += len(data)
+            if not isinstance(data, (FileRegion, Ancillary)):
+                # file regions and descriptors report back by themselves once they are sent
+                sent.append((chan, nbytes, end))
+
+            if self.metrics is not None:
+                self._count_frame_out(len(data))
+                chan._metrics.frames_out += 1
+                chan._metrics.bytes_out += nbytes
+
+            if self.capture is not None:
+                self._capture_frame(Direction.OUT, chan.id, length, data)
+
+        return size, True
+
+    def _writer(self):
+        while True:
+            with self._send_cv:
+                while True:
+                    timeout = self._run_timers() if self._timers else None
+                    if any(self._ready) or self._control or self._closed:
+                        break
+
+                    self._send_cv.wait(timeout)
+
+                if self._closed:
                     return
 
+                buffers, sent, flushed = self._collect_frames()
+
+            if buffers:
+                with self._socket_lock():
+                    try:
+                        sendframes(self._socket, buffers, self._corkable)
+                    except OSError as err:
+                        self._logger.info('Write failed: {0}'.format(err))
+                        # frames are lost, nothing sent after them can be trusted anymore
+                        self._abort()
+                        return
+
+            # payloads were views into the send queues, release them only now
+            for chan, nbytes, end in sent:
+                chan._frame_sent(nbytes, end)
+
+            for i in flushed:
+                i._flushed.set()
+
+    def _run_timers(self):
+        # called with _send_cv held, returns how long until the next deferred channel is due
+        now = time.monotonic()
+        while self._timers:
+            deadline, seq, chan = self._timers[0]
+            if deadline > now:
+                return deadline - now
+
+            heapq.heappop(self._timers)
+            if self._deferred.get(chan.id) is chan:
+                del self._deferred[chan.id]
+                self._ready[chan.priority][chan.id] = chan
+
+        return None
+
+    def _configure_socket(self):
+        # frames are coalesced here already, Nagle would only add latency on top of that
+        self._corkable = False
+        if self.family not in (socket.AF_INET, socket.AF_INET6):
+            return
+
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.nodelay else 0)
+        self._corkable = self.cork and hasattr(socket, 'TCP_CORK')
+
+    @contextlib.contextmanager
+    def _socket_lock(self):
+        metrics = self.metrics
+        if metrics is None:
+            self._lock.acquire()
+        elif not self._lock.acquire(blocking=False):
+            start = time.monotonic()
+            self._lock.acquire()
+            metrics.send_lock_contended += 1
+            metrics.send_lock_wait += time.monotonic() - start
+
+        try:
+            yield
+        finally:
+            self._lock.release()
+
+    def _capture_frame(self, direction, channel_id, length, data=b''):
+        if isinstance(data, (FileRegion, Ancillary)):
+            data = b''
+
+        # control frames are kept whole whatever the snaplen, replay needs them to open channels
+        snaplen = CONTROL_SIZE if channel_id == CONTROL_CHANNEL else None
+        self.capture.record(direction, channel_id, length, data, snaplen)
+
+    def _count_frame_out(self, length):
+        self.metrics.frames_out += 1
+        self.metrics.bytes_out += HEADER_SIZE + length
+        self.metrics.frame_size_out.observe(length)
+
+    def _on_frame(self, channel_id, data, flags=0):
+        if flags & FRAME_SHM:
+            self._on_doorbell(channel_id, data)
+            return
+
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.frames_in += 1
+            metrics.bytes_in += HEADER_SIZE + len(data)
+            metrics.frame_size_in.observe(len(data))
+
+        if self.capture is not None:
+            self._capture_frame(Direction.IN, channel_id, len(data) | flags, data)
+
+        if flags & FRAME_FDS:
+            self._on_fds(channel_id, data)
+            return
+
+        if channel_id == CONTROL_CHANNEL:
+            self._on_control(data)
+            return
+
+        if channel_id in self._closing:
+            # still in flight for a destroyed channel, a new one may already be using the ID
+            return
+
+        chan = self._channels.get(channel_id)
+        if chan is None:
+            # discard the data
+            self._logger.warning('Data from unknown channel {0} received, discarding'.format(channel_id))
+            return
+
+        if self.dispatcher.inline:
+            chan.on_data(data, bool(flags & FRAME_COMPRESSED), bool(flags & FRAME_END))
+            return
+
+        # the payload is a view into the recv buffer, which gets reused as soon as we return
+        self.dispatcher.submit(chan, chan.on_data, bytes(data), bool(flags & FRAME_COMPRESSED), bool(flags & FRAME_END))
+
     def _recv(self):
+        buffer = bytearray(RECV_BUFFER_SIZE)
+        view = memoryview(buffer)
+        start = end = 0
+        recv = self._recv_fds if self.family == socket.AF_UNIX else self._socket.recv_into
+
         while True:
-            try:
-                data = recvall(self._socket, HEADER_SIZE)
-                if data == b'':
-                    self._logger.debug('EOF received')
+            # hand over every complete frame we have, payloads are views into the buffer
+            needed = HEADER_SIZE
+            while end - start >= HEADER_SIZE:
+                magic, channel_id, length = struct.unpack_from(HEADER_FORMAT, buffer, start)
+                if magic != HEADER_MAGIC:
+                    self._logger.debug('Wrong magic received ({0:04x})'.format(magic))
                     self._close()
                     return
 
-                magic, channel_id, length = struct.unpack(HEADER_FORMAT, data)
-                if magic != HEADER_MAGIC:
-                    self._logger.debug('Wrong magic received ({0:04x})'.format(magic))
+                needed = HEADER_SIZE + (length & FRAME_LENGTH_MASK)
+                if end - start < needed:
+                    break
+
+                self._on_frame(channel_id, view[start + HEADER_SIZE:start + needed], length & ~FRAME_LENGTH_MASK)
+                start += needed
+                needed = HEADER_SIZE
+
+            if needed > HEADER_SIZE and self.dispatcher.inline:
+                # partial frame: if a reader is waiting in recv_into(), read the rest right into its buffer
+                try:
+                    direct = self._recv_direct(channel_id, length, view[start + HEADER_SIZE:end])
+                except OSError as err:
+                    self._logger.info('Read failed: {0}'.format(err))
                     self._close()
                     return
 
-                data = recvall(self._socket, length)
-                if channel_id not in self._channels:
-                    # discard the data
-                    self._logger.warning('Data from unknown channel {0} received, discarding'.format(channel_id))
+                if direct:
+                    self._last_recv = time.monotonic()
+                    start = end = 0
                     continue
 
-                chan = self.channels[channel_id]
-                chan.on_data(data)
+            if start == end:
+                start = end = 0
+            elif needed > len(buffer):
+                buffer = bytearray(needed)
+                buffer[:end - start] = view[start:end]
+                view = memoryview(buffer)
+                start, end = 0, end - start
+            elif start + needed > len(buffer):
+                view[:end - start] = view[start:end]
+                start, end = 0, end - start
+
+            try:
+                n = recv(view[end:])
             except OSError as err:
                 self._logger.info('Read failed: {0}'.format(err))
                 self._close()
                 return
 
+            if n == 0:
+                self._logger.debug('EOF received')
+                self._close()
+                return
+
+            self._last_recv = time.monotonic()
+            end += n
+
+    def _on_doorbell(self, channel_id, data):
+        if len(data) != SHM_DOORBELL_SIZE:
+            self._logger.warning('Truncated shared memory frame for channel {0} received, discarding'.format(channel_id))
+            return
+
+        if channel_id in self._closing:
+            return
+
+        chan = self._channels.get(channel_id)
+        segment = None
+        generation, nbytes, position = struct.unpack_from(SHM_DOORBELL_FORMAT, data)
+        if chan is not None:
+            segment = chan._segments.get(generation)
+
+        if segment is None or nbytes > segment.size:
+            self._logger.warning('Shared memory frame for channel {0} points nowhere, discarding'.format(channel_id))
+            return
+
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.frames_in += 1
+            metrics.bytes_in += HEADER_SIZE + nbytes
+            metrics.frame_size_in.observe(nbytes)
+
+        if self.capture is not None:
+            # recorded as if the payload had come over the socket, that's what a replay sends
+            self._capture_frame(Direction.IN, channel_id, nbytes, segment.read(position, nbytes))
+
+        if self.dispatcher.inline:
+            chan.on_shm_data(segment, position, nbytes)
+            return
+
+        self.dispatcher.submit(chan, chan.on_shm_data, segment, position, nbytes)
+
+    def _on_fds(self, channel_id, data):
+        # descriptors arrive with the first byte of this payload, so they are queued already
+        count, = struct.unpack_from('I', data)
+        if count > len(self._fds):
+            self._logger.warning('Peer passed fewer file descriptors than announced')
+            count = len(self._fds)
+
+        fds = [self._fds.popleft() for i in range(count)]
+        if channel_id == CONTROL_CHANNEL:
+            self._on_segment(data, fds)
+            return
+
+        chan = self._channels.get(channel_id)
+        if chan is None:
+            self._logger.warning('File descriptors for unknown channel {0} received, closing them'.format(channel_id))
+            for i in fds:
+                os.close(i)
+
+            return
+
+        self.dispatcher.submit(chan, chan.on_fds, fds)
+
+    def _on_segment(self, data, fds):
+        if len(fds) != 1 or len(data) != 4 + CONTROL_SIZE:
+            self._logger.warning('Unexpected file descriptors on the control channel, closing them')
+            for i in fds:
+                os.close(i)
+
+            return
+
+        command, channel_id, generation = struct.unpack_from(CONTROL_FORMAT, data, 4)
+        try:
+            segment = SharedSegment(fds[0], generation)
+        except (OSError, ValueError) as err:
+            self._logger.warning('Cannot map shared memory segment of channel {0}: {1}'.format(channel_id, err))
+            return
+        finally:
+            os.close(fds[0])
+
+        with self._lock:
+            if channel_id in self._closing:
+                # belongs to the instance we destroyed
+                return
+
+            chan = self._channels.get(channel_id)
+            if chan is None:
+                self._pending_control.setdefault(channel_id, []).append((ControlCommand.SEGMENT, segment))
+                return
+
+        chan.on_segment(segment)
+
+    def _recv_fds(self, view):
+        n, ancdata, flags, addr = self._socket.recvmsg_into((view,), socket.CMSG_SPACE(MAX_FDS * FDS_ITEMSIZE))
+        for level, type, data in ancdata:
+            if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                fds = array.array('i')
+                fds.frombytes(data[:len(data) - len(data) % FDS_ITEMSIZE])
+                self._fds.extend(fds)
+
+        if flags & socket.MSG_CTRUNC:
+            self._logger.warning('File descriptors passed by the peer were truncated')
+
+        return n
+
+    def _recv_direct(self, channel_id, length, head):
+        chan = self._channels.get(channel_id)
+        if chan is None or chan._sink is None or length & ~FRAME_LENGTH_MASK:
+            return False
+
+        target = chan._claim_sink(length)
+        if target is None:
+            return False
+
+        target[:len(head)] = head
+        done = len(head)
+        try:
+            while done < length:
+                n = self._socket.recv_into(target[done:])
+                if n == 0:
+                    raise OSError(errno.ECONNRESET, 'Connection closed in the middle of a frame')
+
+                done += n
+        except BaseException:
+            chan._sink_filled(0)
+            raise
+
+        if self.metrics is not None:
+            self.metrics.frames_in += 1
+            self.metrics.bytes_in += HEADER_SIZE + length
+            self.metrics.frame_size_in.observe(length)
+
+        if self.capture is not None:
+            self._capture_frame(Direction.IN, channel_id, length, target[:length])
+
+        chan._sink_filled(length)
+        return True
+
     def _close(self):
-        self._closed = True
+        with self._send_cv:
+            self._closed = True
+            for i in self._ready:
+                i.clear()
+
+            self._control.clear()
+            self._deferred.clear()
+            self._timers.clear()
+            self._send_cv.notify()
+
         self._logger.debug('Connection closed')
+        DEFAULT_KEEPALIVE.unregister(self)
+        while self._fds:
+            os.close(self._fds.popleft())
+
         for i in list(self.channels.values()):
-            if not i.closed:
-                i.close()
+            self.dispatcher.submit(i, i.on_connection_closed)
 
         self._channels.clear()
-
+        self._closing.clear()
+        self._pending_control.clear()
+        self._send_thread.join()
         with self._lock:
             self._socket.close()
+            self._on_lost()
             self.on_closed()
 
     def close(self):
@@ -155,19 +1041,15 @@ class Client(Connection):
         self._uri = None
 
     def connect(self, uri):
-        parsed = urllib.parse.urlparse(uri, 'tcp')
-        if parsed.scheme == 'tcp':
-            af = socket.AF_INET
-            address = (parsed.hostname, parsed.port)
-        elif parsed.scheme == 'unix':
-            af = socket.AF_UNIX
-            address = parsed.netloc
-        else:
-            raise RuntimeError('Unsupported scheme {0}'.format(parsed.scheme))
-
+        af, address = parse_uri(uri)
+        self._uri = uri
         self._socket = socket.socket(af, socket.SOCK_STREAM)
         self._socket.connect(address)
-        print('main socket fd: {0}'.format(self._socket.fileno()))
+        self._address = address
+        if uri.startswith('shm://'):
+            self.shm = True
+
+        self._logger.debug('Connected to {0}, fd {1}'.format(uri, self._socket.fileno()))
         self.open()
 
     def disconnect(self):
@@ -0,0 +1,156 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+_codecs = {}
+
+
+class Codec(object):
+    id = None
+    name = None
+
+    def compressor(self):
+        raise NotImplementedError()
+
+    def decompressor(self):
+        # returns decompress(data, max_length), which never produces more than max_length bytes
+        raise NotImplementedError()
+
+
+class ZlibCodec(Codec):
+    id = 1
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compressor(self):
+        obj = zlib.compressobj(self.level)
+        # sync flush after every frame, so each one can be decoded on arrival
+        return lambda data: obj.compress(data) + obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def decompressor(self):
+        obj = zlib.decompressobj()
+        return lambda data, max_length: obj.decompress(data, max_length)
+
+
+class Lz4Codec(Codec):
+    id = 2
+    name = 'lz4'
+
+    def compressor(self):
+        obj = lz4.frame.LZ4FrameCompressor(block_linked=True, auto_flush=True)
+        pending = [obj.begin()]
+
+        def compress(data):
+            # the frame header goes out with the first block
+            header, pending[0] = pending[0], b''
+            return header + obj.compress(data)
+
+        return compress
+
+    def decompressor(self):
+        return lz4.frame.LZ4FrameDecompressor().decompress
+
+
+class ZstdCodec(Codec):
+    id = 3
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def compressor(self):
+        obj = zstandard.ZstdCompressor(level=self.level).compressobj()
+        return lambda data: obj.compress(data) + obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def decompressor(self):
+        # decompressobj() has no output limit, a stream writer can be stopped halfway through
+        sink = _BoundedSink()
+        writer = zstandard.ZstdDecompressor().stream_writer(sink)
+
+        def decompress(data, max_length):
+            sink.limit = max_length
+            try:
+                writer.write(data)
+            except _LimitReached:
+                pass
+
+            result, sink.data = bytes(sink.data), bytearray()
+            return result
+
+        return decompress
+
+
+class _LimitReached(Exception):
+    pass
+
+
+class _BoundedSink(object):
+    def __init__(self):
+        self.data = bytearray()
+        self.limit = 0
+
+    def write(self, data):
+        self.data += data[:self.limit - len(self.data)]
+        if len(self.data) >= self.limit:
+            raise _LimitReached()
+
+        return len(data)
+
+
+def register_codec(codec):
+    _codecs[codec.id] = codec
+    _codecs[codec.name] = codec
+
+
+def get_codec(key):
+    if isinstance(key, Codec):
+        return key
+
+    return _codecs.get(key)
+
+
+register_codec(ZlibCodec())
+
+if lz4:
+    register_codec(Lz4Codec())
+
+if zstandard:
+    register_codec(ZstdCodec())
@@ -0,0 +1,111 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import collections
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class Dispatcher(object):
+    """
+    Runs every callback straight away on the calling thread.
+    """
+    inline = True
+
+    def submit(self, key, fn, *args):
+        fn(*args)
+
+    def call(self, fn, *args):
+        return fn(*args)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class ExecutorDispatcher(Dispatcher):
+    """
+    Runs callbacks on a concurrent.futures executor. Callbacks submitted under the
+    same key run one at a time, in submission order; different keys run in parallel.
+
+    Submitted callbacks touch in-process state, so with a ProcessPoolExecutor they run
+    on a thread instead and only what goes through call() is shipped to the workers.
+    """
+    inline = False
+
+    def __init__(self, executor=None, local_executor=None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._executor = executor or ThreadPoolExecutor(thread_name_prefix='msock dispatch')
+        self._local_executor = local_executor
+        self._remote = isinstance(self._executor, ProcessPoolExecutor)
+        if self._local_executor is None:
+            self._local_executor = ThreadPoolExecutor(thread_name_prefix='msock dispatch') if self._remote else self._executor
+
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        return self._executor
+
+    def submit(self, key, fn, *args):
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((fn, args))
+                return
+
+            self._queues[key] = collections.deque([(fn, args)])
+
+        self._local_executor.submit(self._drain, key)
+
+    def call(self, fn, *args):
+        if self._remote:
+            return self._executor.submit(fn, *args).result()
+
+        return fn(*args)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+        if self._local_executor is not self._executor:
+            self._local_executor.shutdown(wait)
+
+    def _drain(self, key):
+        # at most one drain runs per key, that's what keeps callbacks in order
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+
+                fn, args = queue.popleft()
+
+            try:
+                fn(*args)
+            except Exception:
+                self._logger.exception('Callback {0} for {1} failed'.format(fn, key))
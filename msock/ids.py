@@ -0,0 +1,71 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import collections
+import threading
+
+
+CHANNEL_ID_MASK = 0xffffffff
+
+
+class ChannelIdAllocator(object):
+    """
+    Hands out channel IDs of a single parity, so both ends of a connection can open
+    channels without agreeing on IDs first: clients use odd ones, servers even ones.
+    Released IDs are reused oldest first, fresh ones wrap around at 32 bits.
+    """
+    CLIENT = 1
+    SERVER = 0
+
+    def __init__(self, parity=CLIENT):
+        self.parity = parity
+        self._next = parity or 2
+        self._free = collections.deque()
+        self._lock = threading.Lock()
+
+    def owns(self, id):
+        return id & 1 == self.parity
+
+    def allocate(self, in_use):
+        with self._lock:
+            while self._free:
+                id = self._free.popleft()
+                if not in_use(id):
+                    return id
+
+            for i in range(CHANNEL_ID_MASK // 2):
+                id = self._next
+                self._next = (id + 2) & CHANNEL_ID_MASK or 2
+                if not in_use(id):
+                    return id
+
+        raise RuntimeError('Out of channel IDs')
+
+    def release(self, id):
+        if self.owns(id):
+            with self._lock:
+                self._free.append(id)
@@ -0,0 +1,83 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import logging
+import threading
+import time
+
+
+class Keepalive(object):
+    """
+    A single thread per process that drives the heartbeat of every registered connection:
+    it sends pings, closes connections whose peer went silent and reaps idle channels.
+    Each connection tells it when it next needs attention, in between the thread sleeps.
+    """
+    def __init__(self):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._connections = set()
+        self._cv = threading.Condition()
+        self._changed = False
+        self._thread = None
+
+    def register(self, conn):
+        with self._cv:
+            self._connections.add(conn)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='msock keepalive thread')
+                self._thread.start()
+
+            self._changed = True
+            self._cv.notify()
+
+    def unregister(self, conn):
+        with self._cv:
+            self._connections.discard(conn)
+
+    def _run(self):
+        while True:
+            with self._cv:
+                connections = list(self._connections)
+
+            deadline = None
+            for conn in connections:
+                try:
+                    due = conn._heartbeat(time.monotonic())
+                except Exception:
+                    self._logger.exception('Heartbeat of connection {0} failed'.format(conn.fileno()))
+                    continue
+
+                if due is not None and (deadline is None or due < deadline):
+                    deadline = due
+
+            with self._cv:
+                if not self._changed:
+                    self._cv.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+                self._changed = False
+
+
+DEFAULT_KEEPALIVE = Keepalive()
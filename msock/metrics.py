@@ -0,0 +1,198 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import bisect
+import collections
+
+
+FRAME_SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144)
+RTT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class Histogram(object):
+    def __init__(self, bounds=FRAME_SIZE_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {
+            'buckets': list(zip(self.bounds + (float('inf'),), self.counts)),
+            'count': self.count,
+            'sum': self.sum
+        }
+
+
+class ChannelMetrics(object):
+    """
+    Payload bytes and frames of a single channel, as the application sees them:
+    counted before compression on the way out and after decompression on the way in.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.recvq_high_water = 0
+        self.sendq_high_water = 0
+
+    def snapshot(self):
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'recvq_high_water': self.recvq_high_water,
+            'sendq_high_water': self.sendq_high_water,
+            'recv_blocked': self.channel._recvq.read_blocked,
+            'send_blocked': self.channel._sendq.write_blocked
+        }
+
+
+class ConnectionMetrics(object):
+    """
+    Wire level counters of a connection, headers and control frames included.
+    """
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.send_lock_contended = 0
+        self.send_lock_wait = 0.0
+        self.frame_size_in = Histogram()
+        self.frame_size_out = Histogram()
+        self.rtt = Histogram(RTT_BUCKETS)
+        self.channels = {}
+
+    def channel(self, chan):
+        metrics = self.channels[chan.id] = ChannelMetrics(chan)
+        return metrics
+
+    def snapshot(self):
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'send_lock_contended': self.send_lock_contended,
+            'send_lock_wait': self.send_lock_wait,
+            'frame_size_in': self.frame_size_in.snapshot(),
+            'frame_size_out': self.frame_size_out.snapshot(),
+            'rtt': self.rtt.snapshot(),
+            'channels': {id: i.snapshot() for id, i in list(self.channels.items())}
+        }
+
+
+CONNECTION_METRICS = (
+    ('bytes_in', 'counter', 'Bytes received, including headers'),
+    ('bytes_out', 'counter', 'Bytes sent, including headers'),
+    ('frames_in', 'counter', 'Frames received'),
+    ('frames_out', 'counter', 'Frames sent'),
+    ('send_lock_contended', 'counter', 'Sends that had to wait for the socket lock'),
+    ('send_lock_wait', 'counter', 'Seconds spent waiting for the socket lock')
+)
+
+CONNECTION_HISTOGRAMS = (
+    ('frame_size_in', 'Size of frames received'),
+    ('frame_size_out', 'Size of frames sent'),
+    ('rtt', 'Keepalive round-trip time in seconds')
+)
+
+CHANNEL_METRICS = (
+    ('bytes_in', 'counter', 'Payload bytes received'),
+    ('bytes_out', 'counter', 'Payload bytes sent'),
+    ('frames_in', 'counter', 'Data frames received'),
+    ('frames_out', 'counter', 'Data frames sent'),
+    ('recvq_high_water', 'gauge', 'Highest receive queue occupancy in bytes'),
+    ('sendq_high_water', 'gauge', 'Highest send queue occupancy in bytes'),
+    ('recv_blocked', 'counter', 'Seconds readers spent blocked on an empty receive queue'),
+    ('send_blocked', 'counter', 'Seconds writers spent blocked on a full send queue')
+)
+
+
+def export_prometheus(connections, prefix='msock'):
+    """
+    Renders the metrics of the given connections in the Prometheus text format.
+    Connections without metrics enabled are skipped.
+    """
+    families = collections.OrderedDict()
+
+    def sample(name, type, help, labels, value):
+        family = families.setdefault(name, (type, help, []))
+        family[2].append((labels, value))
+
+    for conn in connections:
+        if conn.metrics is None:
+            continue
+
+        snapshot = conn.metrics.snapshot()
+        labels = (('connection', str(conn.fileno())),)
+        if conn.remote_address:
+            labels += (('peer', str(conn.remote_address)),)
+
+        for name, type, help in CONNECTION_METRICS:
+            sample('{0}_connection_{1}'.format(prefix, name), type, help, labels, snapshot[name])
+
+        for key, help in CONNECTION_HISTOGRAMS:
+            name = '{0}_connection_{1}'.format(prefix, key)
+            histogram = snapshot[key]
+            total = 0
+            for bound, count in histogram['buckets']:
+                total += count
+                le = '+Inf' if bound == float('inf') else str(bound)
+                sample(name + '_bucket', 'histogram', help, labels + (('le', le),), total)
+
+            sample(name + '_count', 'histogram', help, labels, histogram['count'])
+            sample(name + '_sum', 'histogram', help, labels, histogram['sum'])
+
+        for id, channel in snapshot['channels'].items():
+            chan_labels = labels + (('channel', str(id)),)
+            for name, type, help in CHANNEL_METRICS:
+                sample('{0}_channel_{1}'.format(prefix, name), type, help, chan_labels, channel[name])
+
+    lines = []
+    declared = set()
+    for name, (type, help, samples) in families.items():
+        base = name.rsplit('_', 1)[0] if type == 'histogram' else name
+        if base not in declared:
+            declared.add(base)
+            lines.append('# HELP {0} {1}'.format(base, help))
+            lines.append('# TYPE {0} {1}'.format(base, type))
+
+        for labels, value in samples:
+            rendered = ','.join('{0}="{1}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+            lines.append('{0}{{{1}}} {2}'.format(name, rendered, value))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,176 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import enum
+import logging
+import threading
+import time
+from msock.buffers import BufferPolicy
+from msock.channel import KEEPALIVE_INTERVAL, KEEPALIVE_TIMEOUT
+from msock.client import Client, MAX_FRAME_SIZE
+from msock.dispatch import Dispatcher
+from msock.ids import ChannelIdAllocator
+from msock.metrics import ConnectionMetrics
+
+
+class Placement(enum.Enum):
+    HASH = 'hash'
+    LEAST_LOADED = 'least-loaded'
+
+
+class ClientPool(object):
+    def __init__(self, size=4, placement=Placement.HASH):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.on_channel_created = lambda chan: None
+        self.on_member_connected = lambda client: None
+        self.on_member_closed = lambda client: None
+        self.buffer_policy = BufferPolicy()
+        self.memory_budget = None
+        self.dispatcher = Dispatcher()
+        self.max_frame_size = MAX_FRAME_SIZE
+        self.collect_metrics = False
+        self.nodelay = True
+        self.cork = True
+        self.keepalive_interval = KEEPALIVE_INTERVAL
+        self.keepalive_timeout = KEEPALIVE_TIMEOUT
+        self.reconnect_interval = 0.5
+        self.reconnect_max_interval = 30
+        self._size = size
+        self._placement = placement
+        self._uri = None
+        self._members = [None] * size
+        self._owners = {}
+        self._ids = ChannelIdAllocator()
+        self._closing = False
+        self._lock = threading.RLock()
+
+    @property
+    def members(self):
+        return [i for i in self._members if i and not i.closed]
+
+    @property
+    def channels(self):
+        with self._lock:
+            return {id: self._members[i].channels[id] for id, i in self._owners.items()
+                    if self._members[i] and id in self._members[i].channels}
+
+    def connect(self, uri):
+        self._uri = uri
+        self._closing = False
+        for i in range(self._size):
+            self._members[i] = self._connect_member(i)
+
+    def create_channel(self, id=None, policy=None, compression=None, type=None, priority=None, weight=None):
+        with self._lock:
+            if id is None:
+                id = self._ids.allocate(self._owners.__contains__)
+
+            index = self._pick(id)
+            chan = self._members[index].create_channel(
+                id, policy=policy, compression=compression, type=type, priority=priority, weight=weight
+            )
+            self._owners[id] = index
+
+        self.on_channel_created(chan)
+        return chan
+
+    def destroy_channel(self, id):
+        with self._lock:
+            index = self._owners.pop(id)
+            self._ids.release(id)
+            member = self._members[index]
+            if member and id in member.channels:
+                member.destroy_channel(id)
+
+    def disconnect(self):
+        self._closing = True
+        for i in self._members:
+            if i:
+                i.disconnect()
+
+    close = disconnect
+
+    def _pick(self, id):
+        healthy = [i for i, m in enumerate(self._members) if m and not m.closed]
+        if not healthy:
+            raise RuntimeError('No pool member connected to {0}'.format(self._uri))
+
+        if self._placement == Placement.LEAST_LOADED:
+            return min(healthy, key=lambda i: len(self._members[i].channels))
+
+        # stick to the hashed member, fall over to the next healthy one while it reconnects
+        # IDs are all odd, the parity bit carries nothing
+        index = hash(id >> 1) % self._size
+        return next((i for i in healthy if i >= index), healthy[0])
+
+    def _connect_member(self, index):
+        client = Client()
+        client.buffer_policy = self.buffer_policy
+        client.memory_budget = self.memory_budget
+        client.dispatcher = self.dispatcher
+        client.max_frame_size = self.max_frame_size
+        client.metrics = ConnectionMetrics() if self.collect_metrics else None
+        client.nodelay = self.nodelay
+        client.cork = self.cork
+        client.keepalive_interval = self.keepalive_interval
+        client.keepalive_timeout = self.keepalive_timeout
+        client.on_closed = lambda: self._on_member_closed(index, client)
+        client.connect(self._uri)
+        self.on_member_connected(client)
+        return client
+
+    def _on_member_closed(self, index, client):
+        # runs on the member's recv thread with its lock held, leave the pool lock alone
+        self.on_member_closed(client)
+        if not self._closing:
+            threading.Thread(
+                target=self._reconnect,
+                args=(index,),
+                daemon=True,
+                name='msock pool reconnect {0}'.format(index)
+            ).start()
+
+    def _reconnect(self, index):
+        with self._lock:
+            for id in [id for id, i in self._owners.items() if i == index]:
+                del self._owners[id]
+
+        interval = self.reconnect_interval
+        while not self._closing:
+            try:
+                client = self._connect_member(index)
+            except OSError as err:
+                self._logger.info('Reconnecting pool member {0} failed: {1}'.format(index, err))
+                time.sleep(interval)
+                interval = min(interval * 2, self.reconnect_max_interval)
+                continue
+
+            with self._lock:
+                self._members[index] = client
+
+            self._logger.debug('Pool member {0} reconnected to {1}'.format(index, self._uri))
+            return
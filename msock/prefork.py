@@ -0,0 +1,167 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+from msock.aio import AsyncServer, ASYNC_SCHEMES
+from msock.utils import parse_uri
+
+
+class PreforkServer(object):
+    def __init__(self, workers=None):
+        self.on_connection = lambda conn: None
+        self.on_worker_started = lambda index: None
+        self.drain_timeout = 30
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._nworkers = workers or os.cpu_count() or 1
+        self._uri = None
+        self._af = None
+        self._address = None
+        self._socket = None
+        self._workers = {}
+        self._current = {}
+        self._running = False
+
+    @property
+    def workers(self):
+        return dict(self._current)
+
+    def open(self, uri):
+        self._af, self._address = parse_uri(uri, ASYNC_SCHEMES)
+        self._uri = uri
+        if self._af == socket.AF_UNIX or not hasattr(socket, 'SO_REUSEPORT'):
+            # one listening socket, inherited by every worker
+            self._socket = self._listen()
+            return
+
+        # every worker binds its own SO_REUSEPORT socket, check the address is usable now
+        self._listen().close()
+
+    def run(self):
+        self._running = True
+        signal.signal(signal.SIGTERM, lambda signo, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signo, frame: self.stop())
+        signal.signal(signal.SIGHUP, lambda signo, frame: self.restart())
+
+        for i in range(self._nworkers):
+            self._spawn(i)
+
+        while self._workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            index = self._workers.pop(pid, None)
+            if index is None or self._current.get(index) != pid:
+                continue
+
+            del self._current[index]
+            if self._running:
+                self._logger.warning('Worker {0} (pid {1}) exited with status {2}, restarting'.format(index, pid, status))
+                self._spawn(index)
+
+        if self._socket:
+            self._socket.close()
+
+    def stop(self):
+        self._running = False
+        for pid in list(self._workers):
+            self._kill(pid)
+
+    def restart(self):
+        # bring up a fresh worker for every slot first, then let the old one drain
+        for index, pid in list(self._current.items()):
+            self._spawn(index)
+            self._kill(pid)
+
+    def _kill(self, pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def _listen(self):
+        sock = socket.socket(self._af, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self._af != socket.AF_UNIX and hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        if self._af == socket.AF_UNIX and os.path.exists(self._address):
+            os.unlink(self._address)
+
+        sock.bind(self._address)
+        sock.listen()
+        return sock
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self._workers[pid] = index
+            self._current[index] = pid
+            return
+
+        status = 0
+        try:
+            self._worker(index)
+        except BaseException:
+            self._logger.exception('Worker {0} failed'.format(index))
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _worker(self, index):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        loop = asyncio.SelectorEventLoop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._serve(index))
+        finally:
+            loop.close()
+
+    async def _serve(self, index):
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stopping.set)
+
+        sock = self._socket or self._listen()
+        server = AsyncServer()
+        server.on_connection = self.on_connection
+        await server.listen(sock)
+        await server.start()
+        self._logger.debug('Worker {0} (pid {1}) listening on {2}'.format(index, os.getpid(), self._uri))
+        self.on_worker_started(index)
+
+        await stopping.wait()
+        self._logger.debug('Worker {0} draining {1} connections'.format(index, len(server.connections)))
+        await server.drain(self.drain_timeout)
@@ -0,0 +1,168 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import argparse
+import logging
+import struct
+import threading
+import time
+from msock.capture import Direction, read_capture
+from msock.channel import ChannelType
+from msock.client import (
+    Client, CONTROL_CHANNEL, CONTROL_FORMAT, CONTROL_SIZE, CHANNEL_TYPES, FRAME_END, FRAME_FDS, FRAME_LENGTH_MASK,
+    ControlCommand
+)
+from msock.server import Server
+
+
+class Replayer(object):
+    """
+    Plays the frames of a capture back through a live connection, with the original timing
+    divided by speed, or as fast as possible with a speed of 0. Payloads cut short by the
+    capture snaplen are padded with zeros, descriptors passed along are not replayed and
+    compressed frames are sent as they were on the wire.
+    """
+    def __init__(self, path, direction=Direction.OUT, speed=1.0):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.direction = direction
+        self.speed = speed
+        self.records = [i for i in read_capture(path) if i.direction == direction]
+        self.frames = 0
+        self.bytes = 0
+
+    def run(self, conn):
+        types = {}
+        parts = {}
+        conn.on_channel_created = self._drain
+        start = time.monotonic()
+        first = self.records[0].timestamp if self.records else 0
+        for record in self.records:
+            if record.length & FRAME_FDS:
+                continue
+
+            if record.channel_id == CONTROL_CHANNEL:
+                if len(record.payload) < CONTROL_SIZE:
+                    continue
+
+                # the live connection does its own flow control, only channel lifetimes matter
+                command, channel_id, argument = struct.unpack_from(CONTROL_FORMAT, record.payload)
+                if command == ControlCommand.OPEN and argument < len(CHANNEL_TYPES):
+                    types[channel_id] = CHANNEL_TYPES[argument]
+                elif command == ControlCommand.CLOSE and channel_id in conn.channels:
+                    conn.destroy_channel(channel_id)
+
+                continue
+
+            if self.speed:
+                delay = (record.timestamp - first) / 1e9 / self.speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            chan = conn.channels.get(record.channel_id)
+            if chan is None:
+                chan = conn.create_channel(record.channel_id, type=types.get(record.channel_id))
+
+            size = record.length & FRAME_LENGTH_MASK
+            end = record.length & FRAME_END
+            if not size and not end:
+                chan.close()
+                continue
+
+            payload = record.payload + bytes(size - len(record.payload))
+            if chan.type == ChannelType.MESSAGE:
+                parts.setdefault(chan.id, []).append(payload)
+                if end:
+                    chan.writev(parts.pop(chan.id))
+            else:
+                chan.write(payload)
+
+            self.frames += 1
+            self.bytes += size
+
+        for i in list(conn.channels.values()):
+            i.flush()
+
+        return time.monotonic() - start
+
+    def _drain(self, chan):
+        # whatever the peer sends back is read and dropped, so it never runs out of window
+        def drain():
+            if chan.type == ChannelType.MESSAGE:
+                while chan.recv_message() is not None:
+                    pass
+
+                return
+
+            while chan.recv(65536):
+                pass
+
+        threading.Thread(target=drain, daemon=True, name='msock replay drain {0}'.format(chan.id)).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m msock.replay', description='replay an msock capture')
+    parser.add_argument('capture', help='capture file to replay')
+    parser.add_argument('uri', help='where to connect, or where to listen with --listen')
+    parser.add_argument('-d', '--direction', choices=('in', 'out'), default='out',
+                        help='replay the frames the capturing side received or sent (default: out)')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='speed-up over the original timing, 0 for as fast as possible (default: 1)')
+    parser.add_argument('-l', '--listen', action='store_true', help='replay to every client connecting to uri')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    direction = Direction.IN if args.direction == 'in' else Direction.OUT
+
+    def replay(conn):
+        replayer = Replayer(args.capture, direction, args.speed)
+        elapsed = replayer.run(conn)
+        print('{0}: replayed {1} frames, {2} bytes in {3:.3f}s'.format(
+            conn.remote_address, replayer.frames, replayer.bytes, elapsed
+        ))
+
+    if args.listen:
+        server = Server()
+        server.accept_channels = True
+        server.on_connection = lambda conn: threading.Thread(target=replay, args=(conn,), daemon=True).start()
+        server.open(args.uri)
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            pass
+
+        return
+
+    client = Client()
+    client.accept_channels = True
+    client.connect(args.uri)
+    replay(client)
+    client.disconnect()
+
+
+if __name__ == '__main__':
+    main()
@@ -24,18 +24,23 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import time
 from threading import Condition
 
 
 class RingBuffer(object):
-    def __init__(self, size):
-        self.data = bytearray(size)
+    def __init__(self, size, allocate=bytearray):
+        # allocate returns the storage for a given size, anything that exports a writable buffer
+        self.allocate = allocate
+        self.data = allocate(size)
         self.view = memoryview(self.data)
         self.size = size
         self.head = 0
         self.tail = 0
         self.closed = False
         self.cv = Condition()
+        self.read_blocked = 0.0
+        self.write_blocked = 0.0
 
     @property
     def empty(self):
@@ -61,9 +66,12 @@ class RingBuffer(object):
         return self.size - self.used_space - 1
 
     def write(self, data):
+        data = memoryview(data).cast('B')
         with self.cv:
             if self.full:
+                start = time.monotonic()
                 self.cv.wait_for(lambda: not self.full or self.closed)
+                self.write_blocked += time.monotonic() - start
                 if self.closed:
                     return 0
 
@@ -85,12 +93,13 @@ class RingBuffer(object):
                 return towrite
 
             if self.head > self.tail:
-                self.view[self.tail:self.head] = data[:towrite]
+                self.view[self.tail:self.tail+towrite] = data[:towrite]
                 self.tail = (self.tail + towrite) % self.size
                 self.cv.notify_all()
                 return towrite
 
     def writeall(self, data):
+        data = memoryview(data).cast('B')
         done = 0
         while done < len(data):
             ret = self.write(data[done:])
@@ -99,52 +108,268 @@ class RingBuffer(object):
 
             done += ret
 
-    def read(self, count):
+    def peek(self, count=None):
         with self.cv:
-            if self.empty:
-                if self.closed:
-                    return b''
+            if count is None:
+                count = self.used_space
 
-                self.cv.wait_for(lambda: not self.empty or self.closed)
+            return self._segments(count)
 
-            toread = min(count, self.used_space)
+    def commit(self, count):
+        with self.cv:
+            self.head = (self.head + min(count, self.used_space)) % self.size
+            self.cv.notify_all()
 
-            if self.tail >= self.head:
-                toread = min(toread, self.tail - self.head)
-                result = bytes(self.view[self.head:self.head+toread])
-                self.head = (self.head + toread) % self.size
-                self.cv.notify_all()
-                return result
+    def read(self, count):
+        with self.cv:
+            if not self._wait_readable():
+                return b''
 
-            if self.head > self.tail:
-                first = min(toread, self.size - self.head)
-                rest = toread - first
+            segments = self._segments(count)
+            result = b''.join(segments)
+            self.head = (self.head + len(result)) % self.size
+            self.cv.notify_all()
+            return result
 
-                if first:
-                    result = bytes(self.view[self.head:self.head+first])
-                    self.head = (self.head + first) % self.size
+    def read_into(self, buffer):
+        buffer = memoryview(buffer).cast('B')
+        with self.cv:
+            if not self._wait_readable():
+                return 0
 
-                if rest:
-                    result += bytes(self.view[:rest])
-                    self.head = (self.head + rest) % self.size
+            done = 0
+            for i in self._segments(len(buffer)):
+                buffer[done:done+len(i)] = i
+                done += len(i)
 
-                self.cv.notify_all()
-                return result
+            self.head = (self.head + done) % self.size
+            self.cv.notify_all()
+            return done
 
     def readall(self, count):
-        result = b''
+        result = bytearray(count)
+        view = memoryview(result)
         done = 0
 
         while done < count:
-            ret = self.read(count - done)
-            if ret == b'':
+            ret = self.read_into(view[done:])
+            if ret == 0:
                 break
 
-            result += ret
+            done += ret
 
-        return result
+        return bytes(view[:done])
+
+    def resize(self, size):
+        with self.cv:
+            used = self.used_space
+            if used >= size:
+                raise ValueError('Cannot shrink below {0} bytes in use'.format(used))
+
+            data = self.allocate(size)
+            done = 0
+            for i in self._segments(used):
+                data[done:done+len(i)] = i
+                done += len(i)
+
+            self.data = data
+            self.view = memoryview(data)
+            self.size = size
+            self.head = 0
+            self.tail = used
+            self.cv.notify_all()
 
     def close(self):
         with self.cv:
             self.closed = True
             self.cv.notify_all()
+
+    def _wait_readable(self):
+        if self.empty:
+            if self.closed:
+                return False
+
+            start = time.monotonic()
+            self.cv.wait_for(lambda: not self.empty or self.closed)
+            self.read_blocked += time.monotonic() - start
+
+        return not self.empty
+
+    def _segments(self, count):
+        # up to two views over the used part of the buffer, in read order
+        count = min(count, self.used_space)
+        first = min(count, self.size - self.head)
+        rest = count - first
+        if rest:
+            return [self.view[self.head:self.head+first], self.view[:rest]]
+
+        if first:
+            return [self.view[self.head:self.head+first]]
+
+        return []
+
+
+class SPSCRingBuffer(RingBuffer):
+    # head and tail are free-running counters: the producer only ever advances tail and
+    # the consumer only ever advances head, so the lock is taken only to park or wake a peer
+    def __init__(self, size, allocate=bytearray):
+        super(SPSCRingBuffer, self).__init__(size, allocate)
+        self.storage = (self.view, size)
+        self.reader_waiting = False
+        self.writer_waiting = 0
+
+    @property
+    def full(self):
+        return self.tail - self.head >= self.size
+
+    @property
+    def used_space(self):
+        return self.tail - self.head
+
+    @property
+    def avail_space(self):
+        return self.size - (self.tail - self.head)
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        if self.full and not self._wait_writable(len(data)):
+            return 0
+
+        view, size = self.storage
+        tail = self.tail
+        towrite = min(len(data), size - (tail - self.head))
+        index = tail % size
+        first = min(towrite, size - index)
+        view[index:index+first] = data[:first]
+        if towrite > first:
+            view[:towrite-first] = data[first:towrite]
+
+        self.tail = tail + towrite
+        if self.reader_waiting:
+            with self.cv:
+                self.cv.notify()
+
+        return towrite
+
+    def produce(self, storage, position, count):
+        # producer side: count bytes have been put in place at tail already, e.g. by a peer
+        # process sharing the storage; they only count if the ring still keeps its data there
+        with self.cv:
+            if self.data is not storage or position != self.tail or count > self.avail_space:
+                return False
+
+            self.tail += count
+            self.cv.notify()
+
+        return True
+
+    def skip(self, count):
+        # producer side, on an empty ring while the consumer is known to be parked elsewhere:
+        # count bytes were handed over without being queued, positions still move past them
+        self.head += count
+        self.tail += count
+
+    def peek(self, count=None):
+        return self._segments(self.used_space if count is None else count)
+
+    def commit(self, count):
+        self._advance(min(count, self.used_space))
+
+    def wait_drained(self):
+        # producer side: block until the consumer has taken everything written so far
+        with self.cv:
+            self.writer_waiting = self.size
+            self.cv.wait_for(lambda: self.tail == self.head or self.closed)
+            self.writer_waiting = 0
+
+        return self.tail == self.head
+
+    def read(self, count):
+        if not self._wait_readable():
+            return b''
+
+        result = b''.join(self._segments(count))
+        self._advance(len(result))
+        return result
+
+    def read_into(self, buffer):
+        buffer = memoryview(buffer).cast('B')
+        if not self._wait_readable():
+            return 0
+
+        done = 0
+        for i in self._segments(len(buffer)):
+            buffer[done:done+len(i)] = i
+            done += len(i)
+
+        self._advance(done)
+        return done
+
+    def resize(self, size):
+        # only the producer, or the consumer while the producer is known to be idle, may resize
+        data = self.allocate(size)
+        with self.cv:
+            head = self.head
+            used = self.tail - head
+            if used > size:
+                raise ValueError('Cannot shrink below {0} bytes in use'.format(used))
+
+            pending = b''.join(self._segments(used))
+            view = memoryview(data)
+            index = head % size
+            first = min(used, size - index)
+            view[index:index+first] = pending[:first]
+            view[:used-first] = pending[first:]
+
+            self.data = data
+            self.view = view
+            self.size = size
+            self.storage = (view, size)
+
+    def _advance(self, count):
+        self.head += count
+        wanted = self.writer_waiting
+        if wanted and self.avail_space >= wanted:
+            with self.cv:
+                self.cv.notify()
+
+    def _wait_readable(self):
+        if self.tail != self.head:
+            return True
+
+        start = time.monotonic()
+        with self.cv:
+            self.reader_waiting = True
+            self.cv.wait_for(lambda: self.tail != self.head or self.closed)
+            self.reader_waiting = False
+
+        self.read_blocked += time.monotonic() - start
+
+        return self.tail != self.head
+
+    def _wait_writable(self, count):
+        # don't get woken up for every byte the consumer frees, wait for a sizeable chunk
+        start = time.monotonic()
+        with self.cv:
+            self.writer_waiting = max(1, min(count, self.size // 4))
+            self.cv.wait_for(lambda: self.avail_space >= self.writer_waiting or self.closed)
+            self.writer_waiting = 0
+
+        self.write_blocked += time.monotonic() - start
+
+        return not self.closed
+
+    def _segments(self, count):
+        tail = self.tail
+        view, size = self.storage
+        head = self.head
+        count = min(count, tail - head)
+        index = head % size
+        first = min(count, size - index)
+        if count > first:
+            return [view[index:index+first], view[:count-first]]
+
+        if first:
+            return [view[index:index+first]]
+
+        return []
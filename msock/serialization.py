@@ -0,0 +1,135 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import json
+import marshal
+import pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# buffers smaller than this are cheaper to copy than to send as a part of their own
+OUT_OF_BAND_THRESHOLD = 16384
+
+_serializers = {}
+
+
+class Serializer(object):
+    id = None
+    name = None
+
+    def dumps(self, obj):
+        """
+        Returns a list of buffers, the encoded object first. Any further buffers are
+        payloads kept out of band, they are referenced and must not change until sent.
+        """
+        raise NotImplementedError()
+
+    def loads(self, buffers):
+        raise NotImplementedError()
+
+
+class PickleSerializer(Serializer):
+    id = 1
+    name = 'pickle'
+
+    def dumps(self, obj):
+        buffers = []
+
+        def out_of_band(buffer):
+            # returning True keeps the buffer inside the pickle stream
+            try:
+                view = buffer.raw()
+            except BufferError:
+                return True
+
+            if view.nbytes < OUT_OF_BAND_THRESHOLD:
+                return True
+
+            buffers.append(view)
+            return False
+
+        return [pickle.dumps(obj, protocol=5, buffer_callback=out_of_band)] + buffers
+
+    def loads(self, buffers):
+        return pickle.loads(buffers[0], buffers=buffers[1:])
+
+
+class MarshalSerializer(Serializer):
+    id = 2
+    name = 'marshal'
+
+    def dumps(self, obj):
+        return [marshal.dumps(obj)]
+
+    def loads(self, buffers):
+        return marshal.loads(buffers[0])
+
+
+class JsonSerializer(Serializer):
+    id = 3
+    name = 'json'
+
+    def dumps(self, obj):
+        return [json.dumps(obj, separators=(',', ':')).encode('utf-8')]
+
+    def loads(self, buffers):
+        return json.loads(bytes(buffers[0]))
+
+
+class MsgpackSerializer(Serializer):
+    id = 4
+    name = 'msgpack'
+
+    def dumps(self, obj):
+        return [msgpack.packb(obj, use_bin_type=True)]
+
+    def loads(self, buffers):
+        return msgpack.unpackb(buffers[0], raw=False)
+
+
+def register_serializer(serializer):
+    _serializers[serializer.id] = serializer
+    _serializers[serializer.name] = serializer
+
+
+def get_serializer(key):
+    if isinstance(key, Serializer):
+        return key
+
+    return _serializers.get(key)
+
+
+register_serializer(PickleSerializer())
+register_serializer(MarshalSerializer())
+register_serializer(JsonSerializer())
+
+if msgpack:
+    register_serializer(MsgpackSerializer())
@@ -28,30 +28,47 @@
 import logging
 import socket
 import threading
-import urllib.parse
-from msock.client import Connection
+from msock.buffers import BufferPolicy
+from msock.channel import KEEPALIVE_INTERVAL, KEEPALIVE_TIMEOUT
+from msock.dispatch import Dispatcher
+from msock.metrics import ConnectionMetrics
+from msock.shm import SHM_BUFFER_POLICY
+from msock.client import Connection, MAX_FRAME_SIZE
+from msock.ids import ChannelIdAllocator
+from msock.utils import parse_uri
 
 
 class Server(object):
     def __init__(self):
         self.on_connection = lambda conn: None
+        self.on_channel_created = lambda chan: None
+        self.buffer_policy = BufferPolicy()
+        self.memory_budget = None
+        self.dispatcher = Dispatcher()
+        self.max_frame_size = MAX_FRAME_SIZE
+        self.collect_metrics = False
+        self.shm_buffer_policy = SHM_BUFFER_POLICY
+        self.accept_channels = False
+        self.nodelay = True
+        self.cork = True
+        self.keepalive_interval = KEEPALIVE_INTERVAL
+        self.keepalive_timeout = KEEPALIVE_TIMEOUT
+        self.idle_timeout = None
+        self.channel_idle_timeout = None
         self._logger = logging.getLogger(self.__class__.__name__)
         self._uri = None
         self._socket = None
         self._connections = []
         self._lock = threading.RLock()
 
-    def open(self, uri):
-        parsed = urllib.parse.urlparse(uri, 'tcp')
-        if parsed.scheme == 'tcp':
-            af = socket.AF_INET
-            address = (parsed.hostname, parsed.port)
-        elif parsed.scheme == 'unix':
-            af = socket.AF_UNIX
-            address = parsed.netloc
-        else:
-            raise RuntimeError('Unsupported scheme {0}'.format(parsed.scheme))
+    @property
+    def connections(self):
+        with self._lock:
+            return list(self._connections)
 
+    def open(self, uri):
+        af, address = parse_uri(uri)
+        self._uri = uri
         self._socket = socket.socket(af, socket.SOCK_STREAM)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._socket.bind(address)
@@ -65,5 +82,30 @@ class Server(object):
             conn = Connection()
             conn._socket = sock
             conn._address = addr
+            conn.buffer_policy = self.buffer_policy
+            conn.memory_budget = self.memory_budget
+            conn.dispatcher = self.dispatcher
+            conn.max_frame_size = self.max_frame_size
+            conn.metrics = ConnectionMetrics() if self.collect_metrics else None
+            conn.shm = self._uri.startswith('shm://')
+            conn.shm_buffer_policy = self.shm_buffer_policy
+            conn.channel_ids = ChannelIdAllocator(ChannelIdAllocator.SERVER)
+            conn.accept_channels = self.accept_channels
+            # channels the client opens right away are accepted before on_connection runs
+            conn.on_channel_created = self.on_channel_created
+            conn.nodelay = self.nodelay
+            conn.cork = self.cork
+            conn.keepalive_interval = self.keepalive_interval
+            conn.keepalive_timeout = self.keepalive_timeout
+            conn.idle_timeout = self.idle_timeout
+            conn.channel_idle_timeout = self.channel_idle_timeout
+            conn._on_lost = lambda conn=conn: self._on_lost(conn)
+            with self._lock:
+                self._connections.append(conn)
+
             conn.open()
             self.on_connection(conn)
+
+    def _on_lost(self, conn):
+        with self._lock:
+            self._connections.remove(conn)
@@ -0,0 +1,75 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import mmap
+import os
+import tempfile
+from msock.buffers import BufferPolicy
+
+
+# payloads skip the socket buffers, so windows may grow as far as a bulk transfer wants
+SHM_BUFFER_POLICY = BufferPolicy(64 * 1024, maximum=4 * 1024 * 1024)
+
+
+class SharedSegment(object):
+    """
+    Storage of a channel's receive ring on a shm:// connection. The receiver creates
+    it and passes it to the peer, which copies payloads right to the spot the ring
+    expects them next, so the socket only carries where they are. Every resize of the
+    ring gets a new segment, told apart from the old ones by its generation.
+    """
+    def __init__(self, fd, generation):
+        self.mmap = mmap.mmap(fd, 0)
+        self.size = len(self.mmap)
+        self.generation = generation
+
+    @classmethod
+    def create(cls, size, generation):
+        if hasattr(os, 'memfd_create'):
+            fd = os.memfd_create('msock', os.MFD_CLOEXEC)
+        else:
+            fd, path = tempfile.mkstemp(prefix='msock-shm-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+            os.unlink(path)
+
+        try:
+            os.ftruncate(fd, size)
+            return cls(fd, generation), fd
+        except BaseException:
+            os.close(fd)
+            raise
+
+    def write(self, position, data):
+        index = position % self.size
+        first = min(len(data), self.size - index)
+        self.mmap[index:index + first] = data[:first]
+        if len(data) > first:
+            self.mmap[:len(data) - first] = data[first:]
+
+    def read(self, position, nbytes):
+        index = position % self.size
+        first = min(nbytes, self.size - index)
+        return self.mmap[index:index + first] + self.mmap[:nbytes - first]
@@ -0,0 +1,173 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import collections
+import struct
+import threading
+from msock.channel import ChannelType
+from msock.serialization import get_serializer, OUT_OF_BAND_THRESHOLD
+
+
+# serializer and object count, followed by the part count of every object and the
+# length of every part, then the parts themselves
+MESSAGE_HEADER_FORMAT = '!BxH'
+MESSAGE_HEADER_SIZE = struct.calcsize(MESSAGE_HEADER_FORMAT)
+MAX_BATCH = 0xffff
+
+
+class TypedChannel(object):
+    """
+    Sends and receives Python objects over a message channel. A message holds one object,
+    or many of them in batch mode, along with any buffers the serializer kept out of band.
+    Small parts are packed together, large ones are handed to the channel as they are and
+    reach the socket without being copied, so they must not change until sent.
+    """
+    def __init__(self, channel, serializer='pickle', batch_size=None):
+        if channel.type != ChannelType.MESSAGE:
+            raise RuntimeError('Channel {0} is not a message channel'.format(channel.id))
+
+        self._serializer = get_serializer(serializer)
+        if not self._serializer:
+            raise RuntimeError('Unsupported serializer {0}'.format(serializer))
+
+        if batch_size is not None and not 0 < batch_size <= MAX_BATCH:
+            raise ValueError('Batch size must be between 1 and {0}'.format(MAX_BATCH))
+
+        self._channel = channel
+        self.batch_size = batch_size
+        self._batch = []
+        self._batch_lock = threading.Lock()
+        self._received = collections.deque()
+        self._recv_lock = threading.Lock()
+
+    @property
+    def channel(self):
+        return self._channel
+
+    @property
+    def serializer(self):
+        return self._serializer
+
+    def send(self, obj):
+        with self._batch_lock:
+            if not self.batch_size:
+                return self._send((obj,))
+
+            self._batch.append(obj)
+            if len(self._batch) < self.batch_size:
+                return 0
+
+            batch, self._batch = self._batch, []
+            return self._send(batch)
+
+    def send_many(self, objs):
+        objs = list(objs)
+        done = 0
+        with self._batch_lock:
+            for i in range(0, len(objs), MAX_BATCH):
+                done += self._send(objs[i:i + MAX_BATCH])
+
+        return done
+
+    def recv(self):
+        with self._recv_lock:
+            while not self._received:
+                message = self._channel.recv_message()
+                if message is None:
+                    raise EOFError('Channel {0} closed'.format(self._channel.id))
+
+                self._received.extend(self._decode(message))
+
+            return self._received.popleft()
+
+    def flush(self):
+        with self._batch_lock:
+            if self._batch:
+                batch, self._batch = self._batch, []
+                self._send(batch)
+
+        self._channel.flush()
+
+    def close(self):
+        self.flush()
+        self._channel.close()
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.recv()
+            except EOFError:
+                return
+
+    def _send(self, objs):
+        serializer = self._serializer
+        encoded = [serializer.dumps(i) for i in objs]
+        parts = [memoryview(p).cast('B') for i in encoded for p in i]
+        table = struct.pack(
+            '{0}{1}H{2}I'.format(MESSAGE_HEADER_FORMAT, len(encoded), len(parts)),
+            serializer.id,
+            len(encoded),
+            *[len(i) for i in encoded],
+            *[len(p) for p in parts]
+        )
+
+        buffers = [bytearray(table)]
+        for part in parts:
+            if len(part) < OUT_OF_BAND_THRESHOLD:
+                buffers[-1] += part
+                continue
+
+            buffers.append(part)
+            buffers.append(bytearray())
+
+        return self._channel.writev(buffers)
+
+    def _decode(self, message):
+        view = memoryview(message)
+        serializer_id, count = struct.unpack_from(MESSAGE_HEADER_FORMAT, view)
+        if serializer_id != self._serializer.id:
+            raise ValueError('Message on channel {0} was encoded with serializer {1}, expected {2}'.format(
+                self._channel.id, serializer_id, self._serializer.id
+            ))
+
+        offset = MESSAGE_HEADER_SIZE
+        counts = struct.unpack_from('!{0}H'.format(count), view, offset)
+        offset += 2 * count
+        lengths = iter(struct.unpack_from('!{0}I'.format(sum(counts)), view, offset))
+        offset += 4 * sum(counts)
+
+        objs = []
+        for nparts in counts:
+            buffers = []
+            for i in range(nparts):
+                length = next(lengths)
+                buffers.append(view[offset:offset + length])
+                offset += length
+
+            objs.append(self._serializer.loads(buffers))
+
+        return objs
@@ -25,6 +25,15 @@
 #
 #####################################################################
 
+import array
+import errno
+import os
+import socket
+import urllib.parse
+
+
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 16
+
 
 def recvall(s, nbytes):
     result = bytearray(nbytes)
@@ -39,3 +48,104 @@ def recvall(s, nbytes):
         nbytes -= r
 
     return bytes(result)
+
+
+def sendmsgall(s, buffers, ancdata=()):
+    views = [memoryview(i).cast('B') for i in buffers if len(i)]
+    first = 0
+
+    while first < len(views):
+        # ancillary data rides along with the first byte only
+        r = s.sendmsg(views[first:first + IOV_MAX], ancdata)
+        ancdata = ()
+        while r:
+            if r < len(views[first]):
+                views[first] = views[first][r:]
+                break
+
+            r -= len(views[first])
+            first += 1
+
+
+class FileRegion(object):
+    """
+    A piece of a file to be sent with sendfile() in place of a payload buffer.
+    """
+    def __init__(self, fd, offset, count, on_sent=None):
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+        self.on_sent = on_sent
+
+    def __len__(self):
+        return self.count
+
+
+class Ancillary(object):
+    """
+    A payload sent together with file descriptors (SCM_RIGHTS) in a single sendmsg().
+    """
+    def __init__(self, payload, fds, on_sent=None):
+        self.payload = payload
+        self.fds = fds
+        self.on_sent = on_sent
+
+    def __len__(self):
+        return len(self.payload)
+
+
+def sendfileall(s, region):
+    offset = region.offset
+    count = region.count
+    while count:
+        r = os.sendfile(s.fileno(), region.fd, offset, count)
+        if r == 0:
+            raise OSError(errno.EIO, 'File shorter than the region being sent')
+
+        offset += r
+        count -= r
+
+    if region.on_sent:
+        region.on_sent(region.count)
+
+
+def sendframes(s, buffers, cork=False):
+    # buffers may mix bytes-like objects and file regions, keep the order; with cork set
+    # the headers sent ahead of a region don't leave in a segment of their own
+    start = 0
+    corked = False
+    for i, buffer in enumerate(buffers):
+        if cork and not corked and isinstance(buffer, (FileRegion, Ancillary)):
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+            corked = True
+
+        if isinstance(buffer, FileRegion):
+            sendmsgall(s, buffers[start:i])
+            sendfileall(s, buffer)
+            start = i + 1
+        elif isinstance(buffer, Ancillary):
+            sendmsgall(s, buffers[start:i])
+            sendmsgall(s, (buffer.payload,), [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', buffer.fds))])
+            if buffer.on_sent:
+                buffer.on_sent()
+
+            start = i + 1
+
+    sendmsgall(s, buffers[start:])
+    if corked:
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
+
+def parse_uri(uri, schemes=('tcp', 'unix', 'shm')):
+    parsed = urllib.parse.urlparse(uri, 'tcp')
+    if parsed.scheme not in schemes:
+        raise RuntimeError('Unsupported scheme {0}'.format(parsed.scheme))
+
+    if parsed.scheme == 'tcp':
+        return socket.AF_INET, (parsed.hostname, parsed.port)
+
+    if parsed.scheme in ('unix', 'shm'):
+        # shm:// is a unix socket that hands payloads over through shared memory
+        return socket.AF_UNIX, parsed.netloc + parsed.path
+
+    raise RuntimeError('Unsupported scheme {0}'.format(parsed.scheme))
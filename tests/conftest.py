@@ -0,0 +1,84 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import queue
+import threading
+import time
+import pytest
+from msock.client import Client
+from msock.server import Server
+
+
+def connect(uri, client=None):
+    client = client or Client()
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            client.connect(uri)
+            return client
+        except (ConnectionRefusedError, FileNotFoundError):
+            # the server thread may not be listening yet
+            if time.monotonic() > deadline:
+                raise
+
+            time.sleep(0.01)
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+
+        time.sleep(0.01)
+
+    return True
+
+
+def serve(server):
+    server.open(server.uri)
+    # listen right away, so clients don't race the server thread
+    server._socket.listen()
+    threading.Thread(target=server.run, daemon=True).start()
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = Server()
+    server.uri = 'unix://' + str(tmp_path / 'sock')
+    server.accepted = queue.Queue()
+    server.on_connection = server.accepted.put
+    return server
+
+
+@pytest.fixture
+def pair(server):
+    serve(server)
+    client = connect(server.uri)
+    conn = server.accepted.get(timeout=5)
+    yield client, conn
+    client.disconnect()
@@ -0,0 +1,113 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import asyncio
+import socket
+import struct
+import threading
+import pytest
+from msock.aio import AsyncConnection, AsyncServer
+from msock.channel import ChannelType
+from msock.client import HEADER_MAGIC, HEADER_FORMAT, CONTROL_FORMAT, FRAME_END, ControlCommand
+from tests.conftest import connect, wait_for
+
+
+@pytest.fixture
+def async_client(tmp_path):
+    # echo server on its own loop, driven from the threaded client
+    async def echo(chan):
+        while True:
+            data = await chan.read(4096)
+            if not data:
+                return
+
+            chan.write(data)
+            await chan.drain()
+
+    async def main():
+        server = AsyncServer()
+        server.on_connection = on_connection
+        await server.open(uri)
+        await server.start()
+        started.set()
+        await stopped.wait()
+        server.close()
+
+    def on_connection(conn):
+        conn.accept_channels = True
+        conn.on_channel_created = lambda chan: loop.create_task(echo(chan))
+
+    uri = 'unix://' + str(tmp_path / 'sock')
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    stopped = asyncio.Event()
+    thread = threading.Thread(target=loop.run_until_complete, args=(main(),), daemon=True)
+    thread.start()
+    assert started.wait(5)
+    client = connect(uri)
+    yield client
+    client.disconnect()
+    loop.call_soon_threadsafe(stopped.set)
+    thread.join(5)
+
+
+def test_message_channel_is_refused(async_client):
+    chan = async_client.create_channel(type=ChannelType.MESSAGE)
+    assert wait_for(lambda: chan.id not in async_client.channels)
+    data = async_client.create_channel()
+    for i in range(3):
+        data.write(b'echo')
+        assert data.read(4) == b'echo'
+
+
+def test_flagged_frame_closes_channel(async_client):
+    chan = async_client.create_channel()
+    for i in range(3):
+        chan.write(b'echo')
+        assert chan.read(4) == b'echo'
+    async_client._socket.sendall(struct.pack(HEADER_FORMAT, HEADER_MAGIC, chan.id, 4 | FRAME_END) + b'xxxx')
+    assert wait_for(lambda: chan.id not in async_client.channels)
+    other = async_client.create_channel()
+    other.write(b'echo')
+    assert other.read(4) == b'echo'
+
+
+def test_reused_id_ignores_stale_credit():
+    async def main():
+        ours, theirs = socket.socketpair()
+        transport, conn = await asyncio.get_running_loop().create_connection(AsyncConnection, sock=ours)
+        conn.create_channel(1)
+        conn.destroy_channel(1)
+        # the peer granted credit to the old channel before its CLOSE arrived
+        conn._on_control(struct.pack(CONTROL_FORMAT, ControlCommand.WINDOW_UPDATE, 1, 4095))
+        conn._on_control(struct.pack(CONTROL_FORMAT, ControlCommand.CLOSE, 1, 0))
+        chan = conn.create_channel(1)
+        transport.close()
+        theirs.close()
+        return chan._credit
+
+    assert asyncio.run(main()) == 0
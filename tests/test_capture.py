@@ -0,0 +1,81 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import os
+import queue
+import threading
+import pytest
+from msock.capture import Capture, Direction, read_capture
+from msock.client import Client, CONTROL_CHANNEL, FRAME_FDS, FRAME_LENGTH_MASK
+from msock.replay import Replayer
+from tests.conftest import connect, serve
+
+
+@pytest.mark.parametrize('snaplen', [64, 1 << 20])
+def test_shm_capture_and_replay(server, tmp_path, snaplen):
+    path = str(tmp_path / 'capture')
+    channels = queue.Queue()
+    server.uri = 'shm://' + server.uri[len('unix://'):]
+    server.accept_channels = True
+    server.on_channel_created = channels.put
+    serve(server)
+    client = Client()
+    client.capture = Capture(path, 8 << 20, snaplen=snaplen)
+    connect(server.uri, client)
+    a = client.create_channel(1)
+    b = channels.get(timeout=5)
+    data = os.urandom(100000)
+    reply = os.urandom(50000)
+    writer = threading.Thread(target=a.write, args=(data,))
+    writer.start()
+    assert b.read(len(data)) == data
+    writer.join()
+    writer = threading.Thread(target=b.write, args=(reply,))
+    writer.start()
+    assert a.read(len(reply)) == reply
+    writer.join()
+    client.disconnect()
+    client.capture.close()
+
+    records = list(read_capture(path))
+    fds = [i for i in records if i.channel_id == CONTROL_CHANNEL and i.length & FRAME_FDS]
+    assert {i.direction for i in fds} == {Direction.IN, Direction.OUT}
+
+    # replayed payloads are what was recorded, cut to snaplen and padded back with zeros
+    for direction, original in ((Direction.OUT, data), (Direction.IN, reply)):
+        frames = [i for i in records if i.direction == direction and i.channel_id == 1]
+        recorded = b''.join(i.payload + bytes((i.length & FRAME_LENGTH_MASK) - len(i.payload)) for i in frames)
+        assert len(recorded) == len(original)
+        if snaplen >= len(original):
+            assert recorded == original
+
+        target = connect(server.uri)
+        replayer = threading.Thread(target=Replayer(path, direction, speed=0).run, args=(target,))
+        replayer.start()
+        assert channels.get(timeout=5).read(len(recorded)) == recorded
+        replayer.join()
+        target.disconnect()
@@ -0,0 +1,112 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from msock.dispatch import ExecutorDispatcher
+from tests.conftest import connect, serve
+
+
+def whoami(data):
+    # runs in a pool worker, so it has to be importable from there
+    return str(os.getpid()).encode()
+
+
+def test_same_key_runs_in_order():
+    dispatcher = ExecutorDispatcher(ThreadPoolExecutor(4))
+    order = []
+
+    def callback(i):
+        time.sleep(random.random() / 1000)
+        order.append(i)
+
+    for i in range(200):
+        dispatcher.submit('key', callback, i)
+
+    dispatcher.shutdown()
+    assert order == list(range(200))
+
+
+def test_keys_run_in_parallel():
+    dispatcher = ExecutorDispatcher(ThreadPoolExecutor(2))
+    event = threading.Event()
+    done = threading.Event()
+    # the first one only returns once the second one has run, which needs another key
+    dispatcher.submit('a', lambda: event.wait(5) and done.set())
+    dispatcher.submit('b', event.set)
+    assert done.wait(5)
+    dispatcher.shutdown()
+
+
+def test_failing_callback_keeps_draining():
+    dispatcher = ExecutorDispatcher(ThreadPoolExecutor(1))
+    done = threading.Event()
+    dispatcher.submit('key', lambda: 1 / 0)
+    dispatcher.submit('key', done.set)
+    assert done.wait(5)
+    dispatcher.shutdown()
+
+
+def test_callbacks_leave_recv_thread(server):
+    def created(chan):
+        channels.put((chan, threading.current_thread().name))
+
+    channels = queue.Queue()
+    server.dispatcher = ExecutorDispatcher()
+    server.accept_channels = True
+    server.on_channel_created = created
+    serve(server)
+    client = connect(server.uri)
+    a = client.create_channel(1)
+    b, thread = channels.get(timeout=5)
+    assert thread.startswith('msock dispatch')
+    data = os.urandom(100000)
+    writer = threading.Thread(target=a.write, args=(data,))
+    writer.start()
+    assert b.read(len(data)) == data
+    writer.join()
+    client.disconnect()
+    server.dispatcher.shutdown()
+
+
+def test_handler_runs_in_process_pool(server):
+    server.dispatcher = ExecutorDispatcher(ProcessPoolExecutor(1))
+    serve(server)
+    client = connect(server.uri)
+    conn = server.accepted.get(timeout=5)
+    a = client.create_channel(1)
+    b = conn.create_channel(1)
+    b.handler = whoami
+    a.write(b'ping')
+    pid = int(a.recv(64))
+    assert pid != os.getpid()
+    client.disconnect()
+    server.dispatcher.shutdown()
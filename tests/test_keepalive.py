@@ -0,0 +1,97 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import socket
+import threading
+import time
+from msock.client import Client
+from tests.conftest import connect, serve, wait_for
+
+
+def test_ping_measures_rtt(server):
+    serve(server)
+    client = Client()
+    client.keepalive_interval = 0.05
+    connect(server.uri, client)
+    assert wait_for(lambda: client.rtt is not None)
+    assert not client.closed
+    client.disconnect()
+
+
+def test_silent_peer_is_closed(tmp_path):
+    # accepts the connection, but never answers a ping
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(tmp_path / 'sock'))
+    listener.listen()
+    accepted = []
+    threading.Thread(target=lambda: accepted.append(listener.accept()), daemon=True).start()
+    client = Client()
+    client.keepalive_interval = 0.05
+    client.keepalive_timeout = 0.3
+    connect('unix://' + str(tmp_path / 'sock'), client)
+    assert wait_for(lambda: client.closed)
+    listener.close()
+
+
+def test_idle_connection_is_closed(server):
+    server.idle_timeout = 0.3
+    serve(server)
+    client = connect(server.uri)
+    conn = server.accepted.get(timeout=5)
+    a = client.create_channel(1)
+    b = conn.create_channel(1)
+    # traffic keeps it open, pings alone don't
+    for i in range(10):
+        a.write(b'x')
+        assert b.read(1) == b'x'
+        time.sleep(0.1)
+
+    assert not client.closed
+    assert wait_for(lambda: client.closed)
+
+
+def test_idle_channel_is_reaped(server):
+    server.channel_idle_timeout = 0.3
+    serve(server)
+    client = connect(server.uri)
+    conn = server.accepted.get(timeout=5)
+    active = client.create_channel(1)
+    idle = client.create_channel(2)
+    peer = conn.create_channel(1)
+    conn.create_channel(2)
+    for i in range(10):
+        active.write(b'x')
+        assert peer.read(1) == b'x'
+        time.sleep(0.1)
+
+    assert 1 in conn.channels
+    assert 2 not in conn.channels
+    # the peer's CLOSE tears the client's end down as well
+    assert wait_for(lambda: 2 not in client.channels)
+    assert idle.recv(1) == b''
+    assert not client.closed
+    client.disconnect()
@@ -0,0 +1,115 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import os
+import signal
+import subprocess
+import sys
+import pytest
+from tests.conftest import connect, wait_for
+
+
+# every worker answers with its pid and leaves it in a file named after its slot
+MASTER = '''
+import asyncio, os, sys
+from msock.prefork import PreforkServer
+
+async def answer(chan):
+    while await chan.read(4096):
+        chan.write(str(os.getpid()).encode())
+        await chan.drain()
+
+def on_connection(conn):
+    conn.accept_channels = True
+    conn.on_channel_created = lambda chan: asyncio.get_running_loop().create_task(answer(chan))
+
+def on_worker_started(index):
+    with open(os.path.join(sys.argv[2], str(index)), 'w') as f:
+        f.write(str(os.getpid()))
+
+server = PreforkServer(workers=2)
+server.on_connection = on_connection
+server.on_worker_started = on_worker_started
+server.drain_timeout = 1
+server.open(sys.argv[1])
+server.run()
+'''
+
+
+def worker_pid(path):
+    try:
+        with open(path) as f:
+            return int(f.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def ask(uri):
+    client = connect(uri)
+    chan = client.create_channel()
+    chan.write(b'?')
+    pid = int(chan.recv(64))
+    client.disconnect()
+    return pid
+
+
+@pytest.fixture
+def master(tmp_path):
+    uri = 'unix://' + str(tmp_path / 'sock')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.Popen([sys.executable, '-c', MASTER, uri, str(tmp_path)], cwd=root)
+    assert wait_for(lambda: worker_pid(tmp_path / '0') and worker_pid(tmp_path / '1'), timeout=10)
+    yield proc, uri, tmp_path
+    if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+
+
+def test_workers_serve_connections(master):
+    proc, uri, tmp_path = master
+    workers = {worker_pid(tmp_path / '0'), worker_pid(tmp_path / '1')}
+    for i in range(4):
+        assert ask(uri) in workers
+
+
+def test_dead_worker_is_replaced(master):
+    proc, uri, tmp_path = master
+    pid = worker_pid(tmp_path / '0')
+    os.kill(pid, signal.SIGKILL)
+    assert wait_for(lambda: worker_pid(tmp_path / '0') not in (0, pid), timeout=10)
+    workers = {worker_pid(tmp_path / '0'), worker_pid(tmp_path / '1')}
+    assert ask(uri) in workers
+
+
+def test_sigterm_stops_workers(master):
+    proc, uri, tmp_path = master
+    workers = [worker_pid(tmp_path / '0'), worker_pid(tmp_path / '1')]
+    proc.send_signal(signal.SIGTERM)
+    assert proc.wait(10) == 0
+    for pid in workers:
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)
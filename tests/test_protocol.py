@@ -0,0 +1,293 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import os
+import struct
+import threading
+import zlib
+import pytest
+from msock.buffers import BufferPolicy, MemoryBudget
+from msock.channel import ChannelType
+from msock.client import HEADER_MAGIC, HEADER_FORMAT, CONTROL_FORMAT, FRAME_COMPRESSED, ControlCommand
+from msock.compression import ZlibCodec
+from msock.pool import ClientPool
+from tests.conftest import connect, serve, wait_for
+
+
+def test_read_larger_than_window(pair):
+    client, conn = pair
+    a = client.create_channel(1)
+    b = conn.create_channel(1)
+    data = os.urandom(200000)
+    assert len(data) > b.window
+    writer = threading.Thread(target=a.write, args=(data,))
+    writer.start()
+    assert b.read(len(data)) == data
+    writer.join(5)
+    assert not writer.is_alive()
+
+
+def test_read_exactly_window(pair):
+    client, conn = pair
+    a = client.create_channel(1)
+    b = conn.create_channel(1)
+    for size in (b.window, b.window + 1):
+        data = os.urandom(size)
+        a.write(data)
+        assert b.read(size) == data
+
+
+def test_eof(pair):
+    client, conn = pair
+    a = client.create_channel(1)
+    b = conn.create_channel(1)
+    a.write(b'last words')
+    a.close()
+    assert b.read() == b'last words'
+    assert b.read(10) == b''
+
+
+def test_destroy_is_acknowledged(pair):
+    client, conn = pair
+    a = client.create_channel()
+    conn.create_channel(a.id)
+    client.destroy_channel(a.id)
+    assert wait_for(lambda: a.id not in conn.channels)
+    assert wait_for(lambda: not client._closing)
+    # the acknowledged ID is handed out again
+    assert client.create_channel().id == a.id
+
+
+def test_send_many_respects_credit(pair):
+    client, conn = pair
+    a = client.create_channel(1)
+    b = conn.create_channel(1)
+    a.write(b'first')
+    payload = b'A' * 3000 + b'B' * 3000
+    sender = threading.Thread(target=client.send_many, args=([(1, b'A' * 3000), (1, b'B' * 3000)],))
+    sender.start()
+    assert b.read(5 + len(payload)) == b'first' + payload
+    sender.join(5)
+    assert not sender.is_alive()
+
+
+def test_send_many_fills_send_queue_exactly(pair):
+    client, conn = pair
+    a = client.create_channel(1)
+    b = conn.create_channel(1)
+    size = a._sendq.size
+    for send in (lambda: a.writev([b'a' * size, b'b']), lambda: client.send_many([(1, b'a' * size), (1, b'b')])):
+        sender = threading.Thread(target=send)
+        sender.start()
+        assert b.read(size + 1) == b'a' * size + b'b'
+        sender.join(5)
+        assert not sender.is_alive()
+
+
+def test_send_many_splits_large_frames(pair):
+    client, conn = pair
+    client.create_channel(1)
+    b = conn.create_channel(1)
+    data = os.urandom(client.max_frame_size * 3)
+    sender = threading.Thread(target=client.send, args=(1, data))
+    sender.start()
+    assert b.read(len(data)) == data
+    sender.join(5)
+
+
+def test_accepted_channel_is_reported(server):
+    created = []
+    server.accept_channels = True
+    server.on_channel_created = created.append
+    serve(server)
+    client = connect(server.uri)
+    chan = client.create_channel(type=ChannelType.MESSAGE)
+    assert wait_for(lambda: created)
+    assert created[0].id == chan.id and created[0].type == ChannelType.MESSAGE
+    client.disconnect()
+
+
+def test_on_connection_can_talk_to_client(server):
+    received = []
+    server.on_connection = lambda conn: received.append(conn.create_channel(1).read(5))
+    serve(server)
+    client = connect(server.uri)
+    client.create_channel(1).write(b'hello')
+    assert wait_for(lambda: received)
+    assert received == [b'hello']
+    client.disconnect()
+
+
+def test_refused_channel_keeps_connection_alive(server):
+    server.accept_channels = True
+    server.memory_budget = MemoryBudget(20000)
+    serve(server)
+    client = connect(server.uri)
+    conn = server.accepted.get(timeout=5)
+    channels = [client.create_channel() for i in range(3)]
+    # the third one does not fit the budget, the peer closes it again
+    assert wait_for(lambda: channels[2].id not in client.channels)
+    assert wait_for(lambda: not conn._closing and not conn._pending_control)
+    channels[0].write(b'still alive')
+    assert conn.channels[channels[0].id].read(11) == b'still alive'
+    assert not conn.closed
+    client.disconnect()
+
+
+def test_pool_spreads_channels(server):
+    serve(server)
+    pool = ClientPool(size=4)
+    pool.connect(server.uri)
+    for i in range(40):
+        pool.create_channel()
+
+    assert [len(i.channels) for i in pool.members] == [10, 10, 10, 10]
+    pool.disconnect()
+
+
+def test_send_fds_limit(pair):
+    client, conn = pair
+    a = client.create_channel(1)
+    with pytest.raises(ValueError):
+        a.send_fds([0] * 254)
+
+
+def test_compression_with_codec_instance(pair):
+    client, conn = pair
+    a = client.create_channel(1, compression=ZlibCodec(level=1))
+    b = conn.create_channel(1, compression=ZlibCodec(level=9))
+    assert wait_for(lambda: a._compress is not None and b._compress is not None)
+    data = b'compressible ' * 1000
+    writer = threading.Thread(target=a.write, args=(data,))
+    writer.start()
+    assert b.read(len(data)) == data
+    writer.join()
+
+
+def test_decompression_is_bounded_by_window(pair, caplog):
+    client, conn = pair
+    client.create_channel(1)
+    b = conn.create_channel(1, compression='zlib')
+    assert wait_for(lambda: b._decompress is not None)
+    obj = zlib.compressobj()
+    bomb = obj.compress(bytes(64 * 1024 * 1024)) + obj.flush(zlib.Z_SYNC_FLUSH)
+    header = struct.pack(HEADER_FORMAT, HEADER_MAGIC, 1, len(bomb) | FRAME_COMPRESSED)
+    client._socket.sendall(header + bomb)
+    assert wait_for(lambda: 'exceeds the receive window' in caplog.text)
+    assert b._recvq.used_space == 0
+
+
+def test_reused_id_ignores_stale_credit(pair):
+    client, conn = pair
+    client.create_channel(1)
+    conn.create_channel(1)
+    # holding the lock keeps the peer's CLOSE out until the stale grant has been seen
+    with client._lock:
+        client.destroy_channel(1)
+        a = client.create_channel(1)
+        credit = a._credit
+        client._on_control(struct.pack(CONTROL_FORMAT, ControlCommand.WINDOW_UPDATE, 1, 100000))
+        assert a._credit == credit
+
+
+def test_destroy_during_direct_receive(pair):
+    client, conn = pair
+    a = client.create_channel(1)
+    b = conn.create_channel(1, policy=BufferPolicy(262144))
+    other = client.create_channel(3)
+    theirs = conn.create_channel(3)
+    buffer = bytearray(200000)
+    reader = threading.Thread(target=b.recv_into, args=(buffer,))
+    reader.start()
+    assert wait_for(lambda: b._sink is not None)
+    header = struct.pack(HEADER_FORMAT, HEADER_MAGIC, 1, 100000)
+    # keeps the client's answer to the CLOSE from landing in the middle of the frame
+    with client._socket_lock():
+        client._socket.sendall(header + b'x' * 50000)
+        assert wait_for(lambda: b._sink_busy)
+        conn.destroy_channel(1)
+        client._socket.sendall(b'x' * 50000)
+
+    reader.join(5)
+    assert not reader.is_alive()
+    # the recv thread survived and the other channels still work
+    other.write(b'alive')
+    assert theirs.read(5) == b'alive'
+
+
+def test_message_channel_refuses_stream_calls(pair):
+    client, conn = pair
+    m = client.create_channel(type=ChannelType.MESSAGE)
+    calls = (
+        lambda: m.write(b'x' * 20000),
+        lambda: m.send(b'x'),
+        lambda: m.read(5),
+        lambda: m.readinto(bytearray(5)),
+        lambda: m.recv(5),
+        lambda: m.recv_into(bytearray(5)),
+    )
+    for call in calls:
+        with pytest.raises(RuntimeError):
+            call()
+
+
+def test_closed_connection(pair):
+    client, conn = pair
+    a = client.create_channel(1)
+    client.disconnect()
+    with pytest.raises(RuntimeError):
+        client.create_channel(3)
+
+    closer = threading.Thread(target=a.close)
+    closer.start()
+    closer.join(5)
+    assert not closer.is_alive()
+
+
+def test_idle_window_shrinks(server):
+    server.memory_budget = MemoryBudget(1 << 20)
+    server.buffer_policy = BufferPolicy(4096, maximum=65536, idle_timeout=0.2)
+    serve(server)
+    client = connect(server.uri)
+    conn = server.accepted.get(timeout=5)
+    a = client.create_channel(1)
+    b = conn.create_channel(1)
+    data = os.urandom(1 << 20)
+    writer = threading.Thread(target=a.write, args=(data,))
+    writer.start()
+    assert b.read(len(data)) == data
+    writer.join()
+    assert b._recvq.size > 4096
+    # nothing is read or written anymore, the keepalive thread has to take the memory back
+    assert wait_for(lambda: b._recvq.size == 4096, timeout=10)
+    assert server.memory_budget.used == 2 * 4096
+    # and the peer only has as much credit as the smaller window allows
+    writer = threading.Thread(target=a.write, args=(b'x' * 20000,))
+    writer.start()
+    assert b.read(20000) == b'x' * 20000
+    writer.join()
+    client.disconnect()
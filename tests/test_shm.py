@@ -0,0 +1,113 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import asyncio
+import os
+import struct
+import threading
+import pytest
+from msock.aio import AsyncServer
+from msock.client import HEADER_MAGIC, HEADER_FORMAT, FRAME_SHM, SHM_DOORBELL_FORMAT, SHM_DOORBELL_SIZE, ControlCommand
+from tests.conftest import connect, serve, wait_for
+
+
+@pytest.fixture
+def shm_pair(server):
+    server.uri = 'shm://' + server.uri[len('unix://'):]
+    serve(server)
+    client = connect(server.uri)
+    conn = server.accepted.get(timeout=5)
+    yield client, conn
+    client.disconnect()
+
+
+def ring_doorbell(conn, channel_id, generation, nbytes, position):
+    header = struct.pack(HEADER_FORMAT, HEADER_MAGIC, channel_id, SHM_DOORBELL_SIZE | FRAME_SHM)
+    with conn._socket_lock():
+        conn._socket.sendall(header + struct.pack(SHM_DOORBELL_FORMAT, generation, nbytes, position))
+
+
+def test_payloads_are_read_in_place(shm_pair):
+    client, conn = shm_pair
+    a = client.create_channel(1)
+    b = conn.create_channel(1)
+    assert wait_for(lambda: a._peer_segment is not None)
+    copied = []
+    on_data = b.on_data
+    b.on_data = lambda data, *args: copied.append(len(data)) or on_data(data, *args)
+    data = os.urandom(1024 * 1024)
+    writer = threading.Thread(target=a.write, args=(data,))
+    writer.start()
+    assert b.read(len(data)) == data
+    writer.join()
+    # the window grew on the way, every ring it had was shared with the writer
+    assert b._generation > 1
+    assert b._recvq.data is b._segments[b._generation].mmap
+    assert not copied
+
+
+def test_payload_in_superseded_ring(shm_pair):
+    client, conn = shm_pair
+    a = client.create_channel(1)
+    b = conn.create_channel(1)
+    assert wait_for(lambda: a._peer_segment is not None)
+    old = a._peer_segment
+    # the ring moves, like it does when the window grows, while the peer still writes to the old one
+    b._recvq.resize(b._recvq.size * 2)
+    old.write(0, b'hello')
+    ring_doorbell(client, 1, old.generation, 5, 0)
+    assert b.read(5) == b'hello'
+    assert wait_for(lambda: a._peer_segment is not old)
+    a.write(b'world')
+    assert b.read(5) == b'world'
+
+
+def test_segment_before_channel(shm_pair):
+    client, conn = shm_pair
+    b = conn.create_channel(1)
+    assert wait_for(lambda: any(i == ControlCommand.SEGMENT for i, arg in client._pending_control.get(1, ())))
+    a = client.create_channel(1)
+    assert a._peer_segment is not None
+    a.write(b'late')
+    assert b.read(4) == b'late'
+
+
+def test_bogus_doorbell_is_discarded(shm_pair):
+    client, conn = shm_pair
+    a = client.create_channel(1)
+    b = conn.create_channel(1)
+    assert wait_for(lambda: a._peer_segment is not None)
+    for generation, nbytes in ((99, 16), (a._peer_segment.generation, a._peer_segment.size + 1)):
+        ring_doorbell(client, 1, generation, nbytes, 0)
+
+    a.write(b'still alive')
+    assert b.read(11) == b'still alive'
+
+
+def test_async_server_refuses_shm(tmp_path):
+    with pytest.raises(RuntimeError):
+        asyncio.run(AsyncServer().open('shm://' + str(tmp_path / 'sock')))